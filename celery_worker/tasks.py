@@ -2,6 +2,7 @@ from app import flask_app, celery_app, cache
 
 import neuroscout.tasks.report as report
 import neuroscout.tasks.upload as upload
+import neuroscout.tasks.extraction as extraction
 
 
 @celery_app.task(name='workflow.compile')
@@ -25,3 +26,18 @@ def upload_collection(
         filenames, runs, dataset_id, collection_id, descriptions):
     return upload.upload_collection(flask_app, filenames, runs, dataset_id,
                                     collection_id, descriptions, cache)
+
+
+@celery_app.task(name='extraction.extract_unit', autoretry_for=(Exception,),
+                 retry_backoff=True, max_retries=3)
+def extract_unit(stimulus_id, graph, extraction_id, use_cache,
+                 serializer_kwargs):
+    return extraction.extract_unit(
+        flask_app, stimulus_id, graph, extraction_id, use_cache,
+        serializer_kwargs)
+
+
+@celery_app.task(name='extraction.create_predictors')
+def create_predictors(ef_ids, dataset_name, task_name):
+    return extraction.create_predictors(
+        flask_app, ef_ids, dataset_name, task_name)
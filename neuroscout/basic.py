@@ -21,6 +21,9 @@ def create_app(app_settings=None):
         CACHE_DIR=str(app.config['FILE_DIR'] / 'cache'),
         STIMULUS_DIR=str(app.config['FILE_DIR'] / 'stimuli'),
         EXTRACTION_DIR=str(app.config['FILE_DIR'] / 'extracted'),
+        EXTRACTION_CACHE=str(app.config['FILE_DIR'] / 'extraction-cache'),
+        DURATION_CACHE=str(app.config['FILE_DIR'] / 'nifti-durations.json'),
+        HASH_CACHE=str(app.config['FILE_DIR'] / 'stimulus-hashes.json'),
         FEATURE_SCHEMA=str(app.config['CONFIG_PATH'] / 'feature_schema.json'),
         PREDICTOR_SCHEMA=str(
             app.config['CONFIG_PATH'] / 'predictor_schema.json'),
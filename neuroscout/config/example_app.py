@@ -32,6 +32,19 @@ class Config(object):
     # Core variables
     CONFIG_PATH = Path(__file__).resolve().parents[1] / 'config'
     FILE_DIR = Path('/file-data')
+    EXTRACTION_CACHE_SIZE = 10 * 1024 ** 3  # Max size in bytes
+    # Limits of remote API extractors, when extracting with remote_threads
+    REMOTE_EXTRACTORS = {
+        'providers': {
+            'default': {'concurrency': 4, 'rate': 5},
+            'google': {'concurrency': 8, 'rate': 10, 'burst': 20},
+        },
+        'max_retries': 5,
+        'backoff': 1,
+        # Exceptions to retry, besides rate limits, server and
+        # connection errors
+        'retry_on': [],
+    }
     MIGRATIONS_DIR = '/migrations/migrations'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     CACHE_DEFAULT_TIMEOUT = 0
@@ -81,26 +81,58 @@ def setup_dataset(preproc_address, raw_address=None, path=None,
 
 
 @manager.command
-def ingest_from_json(config, reingest=False):
+def ingest_from_json(config, reingest=False, n_jobs=None):
     """ Ingest/update datasets and extracted features from a json config file.
     config_file - json config file detailing datasets and pliers graph_json
     automagic - Force enable datalad automagic
+    n_jobs - Number of processes used to parse runs (overrides config)
     """
-    populate.ingest_from_json(config, reingest=reingest)
+    if n_jobs is not None:
+        n_jobs = int(n_jobs)
+    populate.ingest_from_json(config, reingest=reingest, n_jobs=n_jobs)
 
 
 @manager.command
 def extract_features(extractor_graphs, dataset_name=None, task_name=None,
-                     resample_frequency=None):
+                     resample_frequency=None, incremental=False,
+                     distributed=False, remote_threads=None):
     """ Extract features from a BIDS dataset.
     extractor_graphs - List of Graphs to apply to relevant stimuli
     dataset_name - Dataset name - By default applies to all active datasets
     task - Task name
     resample_frequency - None
+    incremental - Only extract stimuli that have not yet been extracted
+    distributed - Dispatch extraction to celery workers (requires dataset)
+    remote_threads - Number of threads for remote API extractors
     """
+    if distributed:
+        result = populate.dispatch_extraction(
+            extractor_graphs, dataset_name, task_name,
+            incremental=incremental, resample_frequency=resample_frequency)
+        print("Dispatched extraction: {}".format(result.id))
+        return
+    if remote_threads is not None:
+        remote_threads = int(remote_threads)
     populate.extract_features(
         extractor_graphs, dataset_name, task_name,
-        resample_frequency=resample_frequency)
+        incremental=incremental, resample_frequency=resample_frequency,
+        remote_threads=remote_threads)
+
+
+@manager.command
+def materialize_predictor_events(dataset_name):
+    """ Materialize PredictorEvents of all extracted Predictors in a dataset.
+    dataset_name - Dataset name
+    """
+    populate.materialize_predictor_events(dataset_name)
+
+
+@manager.command
+def recompute_predictor_stats(dataset_name):
+    """ Recompute summary statistics of all Predictors in a dataset.
+    dataset_name - Dataset name
+    """
+    populate.recompute_predictor_stats(dataset_name)
 
 
 @manager.command
@@ -5,9 +5,10 @@ from .analysis import (Analysis, Report, NeurovaultCollection,
 from .auth import User, Role, roles_users, user_datastore
 from .group import GroupPredictor, GroupPredictorValue
 from .dataset import Dataset
-from .features import ExtractedFeature, ExtractedEvent
+from .features import ExtractedFeature, ExtractedEvent, ExtractionCheckpoint
 from .predictor import (Predictor, PredictorEvent, PredictorRun,
-                        PredictorCollection)
+                        PredictorCollection, ExtractedPredictorEvent,
+                        LatestPredictor)
 from .run import Run, analysis_run
 from .stimulus import Stimulus, RunStimulus
 from .task import Task
@@ -23,11 +24,14 @@ __all__ = [
     'Dataset',
     'ExtractedFeature',
     'ExtractedEvent',
+    'ExtractionCheckpoint',
     'GroupPredictor',
     'GroupPredictorValue',
     'Predictor',
     'PredictorEvent',
+    'ExtractedPredictorEvent',
     'PredictorRun',
+    'LatestPredictor',
     'PredictorCollection',
     'Report',
     'NeurovaultCollection',
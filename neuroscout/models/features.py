@@ -20,6 +20,9 @@ class ExtractedFeature(db.Model):
 
     created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
     extractor_version = db.Column(db.Float, default=0.1)
+    # Dispatched extraction that created the feature (see
+    # populate.dispatch_extraction)
+    extraction_id = db.Column(db.Text, index=True)
 
     extracted_events = db.relationship(
         'ExtractedEvent', backref='extracted_feature')
@@ -46,3 +49,15 @@ class ExtractedEvent(db.Model):
         db.Integer, db.ForeignKey('stimulus.id'), nullable=False)
     ef_id = db.Column(
         db.Integer, db.ForeignKey(ExtractedFeature.id), nullable=False)
+
+
+class ExtractionCheckpoint(db.Model):
+    """ Progress of an interrupted feature extraction, keyed by extraction
+    job. Written in the same transaction as each batch of events """
+    key = db.Column(db.Text, primary_key=True)
+    # Hash of the stimuli and schema the extraction was planned with
+    plan_hash = db.Column(db.Text, nullable=False)
+    stimuli = db.Column(JSONB, nullable=False)  # Extracted Stimulus ids
+    features = db.Column(JSONB, nullable=False)  # Created EF ids
+    updated_at = db.Column(db.DateTime, default=datetime.datetime.utcnow,
+                           onupdate=datetime.datetime.utcnow)
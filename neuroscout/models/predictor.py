@@ -27,6 +27,8 @@ class Predictor(db.Model):
     predictor_run = db.relationship('PredictorRun')
     active = db.Column(db.Boolean, default=True)  # Actively display or not
     private = db.Column(db.Boolean, default=False)
+    # Extracted events are materialized in ExtractedPredictorEvent
+    materialized = db.Column(db.Boolean, default=False)
     
 
     # Summary statistics computed upon ingeston (or ad hock)
@@ -67,6 +69,9 @@ class Predictor(db.Model):
 
 class PredictorEvent(db.Model):
     """ An event within a Predictor. Onset is relative to run. """
+    __table_args__ = (
+        db.Index("idx_pe_predictor_id_run_id", "predictor_id", "run_id"),
+    )
     id = db.Column(db.Integer, primary_key=True)
 
     onset = db.Column(db.Float, nullable=False)
@@ -77,7 +82,7 @@ class PredictorEvent(db.Model):
     run_id = db.Column(db.Integer, db.ForeignKey('run.id'), nullable=False,
                        index=False)
     predictor_id = db.Column(db.Integer, db.ForeignKey('predictor.id'),
-                             nullable=False, index=True)
+                             nullable=False)
     stimulus_id = db.Column(db.Integer, db.ForeignKey('stimulus.id'))
 
     def __repr__(self):
@@ -85,13 +90,55 @@ class PredictorEvent(db.Model):
             self.run_id, self.predictor.name)
 
 
+class ExtractedPredictorEvent(db.Model):
+    """ Materialized PredictorEvents of an extracted Predictor, computed
+    from ExtractedEvents and RunStimuli. Onset is relative to run. """
+    __table_args__ = (
+        db.Index("idx_epe_predictor_id_run_id", "predictor_id", "run_id"),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+
+    onset = db.Column(db.Float, nullable=False)
+    duration = db.Column(db.Float)
+    value = db.Column(db.String, nullable=False)
+    object_id = db.Column(db.Integer)
+
+    run_id = db.Column(db.Integer, db.ForeignKey('run.id'), nullable=False)
+    predictor_id = db.Column(db.Integer, db.ForeignKey('predictor.id'),
+                             nullable=False)
+    stimulus_id = db.Column(db.Integer, db.ForeignKey('stimulus.id'))
+    stimulus_onset = db.Column(db.Float)
+    stimulus_duration = db.Column(db.Float)
+
+    def __repr__(self):
+        return '<models.ExtractedPredictorEvent[run_id={} predictor={}]>'.\
+            format(self.run_id, self.predictor_id)
+
+
 class PredictorRun(db.Model):
-    """ Predictor run association cache table """
+    """ Predictor run association cache table.
+    Primary key doubles as the (run_id, predictor_id) index """
+    __table_args__ = (
+        db.Index("idx_pr_predictor_id", "predictor_id"),
+    )
     run_id = db.Column(db.Integer, db.ForeignKey('run.id'), primary_key=True)
     predictor_id = db.Column(db.Integer, db.ForeignKey('predictor.id'),
                              primary_key=True)
 
 
+class LatestPredictor(db.Model):
+    """ Newest Predictor for each name within a Task (cache table).
+    Maintained as Predictors are created, to avoid aggregating over all
+    Predictors when only the newest are requested. Private (uploaded)
+    Predictors are tracked separately, so they never shadow public ones """
+    task_id = db.Column(db.Integer, db.ForeignKey('task.id'),
+                        primary_key=True)
+    name = db.Column(db.Text, primary_key=True)
+    private = db.Column(db.Boolean, primary_key=True)
+    predictor_id = db.Column(db.Integer, db.ForeignKey('predictor.id'),
+                             nullable=False, index=True)
+
+
 class PredictorCollection(db.Model):
     """ Predictor Collection Upload """
     id = db.Column(db.Integer, primary_key=True)
@@ -36,6 +36,10 @@ class Run(db.Model):
         'PredictorEvent', backref='run',
         cascade='delete',
         lazy='dynamic')
+    extracted_predictor_events = db.relationship(
+        'ExtractedPredictorEvent',
+        cascade='delete',
+        lazy='dynamic')
     analyses = db.relationship(
         'Analysis', secondary='analysis_run')
 
@@ -19,6 +19,8 @@ class Task(db.Model):
                            nullable=False)
 
     runs = db.relationship('Run', backref='task', cascade="delete")
+    latest_predictors = db.relationship(
+        'LatestPredictor', cascade="delete")
     TR = db.Column(db.Float)
     summary = db.Column(db.Text)  # Summary annotation
 
@@ -1,8 +1,9 @@
 """ Database population methods """
 
-from .extract import extract_features
+from .extract import extract_features, dispatch_extraction
 from .ingest import add_group_predictors, add_task, add_dataset
-from .modify import delete_task
+from .modify import (delete_task, materialize_predictor_events,
+                     recompute_predictor_stats)
 from .setup import ingest_from_json, setup_dataset
 from .convert import convert_stimuli
 
@@ -12,7 +13,10 @@ __all__ = [
     'add_dataset',
     'convert_stimuli',
     'delete_task',
+    'dispatch_extraction',
     'extract_features',
     'ingest_from_json',
+    'materialize_predictor_events',
+    'recompute_predictor_stats',
     'setup_dataset'
 ]
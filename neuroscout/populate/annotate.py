@@ -1,11 +1,56 @@
 from flask import current_app
+import os
 import numpy as np
 import json
 import re
 import pandas as pd
 from pliers.utils import resample
 from .utils import hash_data
-from ..utils.core import listify
+
+
+# Schemas loaded in this process: path -> (mtime, schema, schema hash)
+_schemas = {}
+# Compiled schema patterns
+_patterns = {}
+
+
+def load_schema(path):
+    """ Load a json schema, once per process. The schema is reloaded if the
+    file has been modified since, and its regex patterns are precompiled.
+    The returned schema is shared, and must not be modified.
+    Args:
+        path - json schema file
+    Returns:
+        tuple of schema and schema hash
+    """
+    path = str(path)
+    mtime = os.stat(path).st_mtime
+    cached = _schemas.get(path)
+    if cached is None or cached[0] != mtime:
+        with open(path, 'r') as f:
+            contents = f.read()
+        schema = json.loads(contents)
+
+        # Predictor schemas are keyed by pattern, feature schemas by
+        # extractor (with lists of candidate feature patterns)
+        for key, value in schema.items():
+            if isinstance(value, list):
+                for candidate in value:
+                    for pattern in candidate.get('features', {}):
+                        compile_pattern(pattern)
+            else:
+                compile_pattern(key)
+
+        cached = (mtime, schema, hash_data(contents))
+        _schemas[path] = cached
+    return cached[1], cached[2]
+
+
+def compile_pattern(pattern):
+    """ Compiled regex pattern, compiled once per process """
+    if pattern not in _patterns:
+        _patterns[pattern] = re.compile(pattern)
+    return _patterns[pattern]
 
 
 class Serializer(object):
@@ -15,7 +60,7 @@ class Serializer(object):
             schema - json schema file
             add_all - serialize features that are not in the schema
         """
-        self.schema = json.load(open(schema, 'r'))
+        self.schema, self.schema_hash = load_schema(schema)
         self.add_all = add_all
 
 
@@ -33,11 +78,39 @@ class PredictorSerializer(Serializer):
         self.TR = TR
         super().__init__(current_app.config['PREDICTOR_SCHEMA'], add_all)
 
+    def annotate(self, name):
+        """ Annotate a variable name using the schema
+        Args:
+            name - original variable name
+        Returns a dictionary of annotations (without a name, if the schema
+        does not rename the variable), or None if the variable is not in
+        the schema and add_all is False
+        """
+        for pattern, attr in self.schema.items():
+            regex = compile_pattern(pattern)
+            if regex.match(name):
+                annotated = {
+                    'description': regex.sub(attr['description'], name)
+                    if 'description' in attr else None
+                }
+                if 'name' in attr:
+                    annotated['name'] = regex.sub(attr['name'], name)
+                # Add any additional attributes
+                annotated.update(
+                    {k: v for k, v in attr.items()
+                     if k not in ['name', 'description']})
+                return annotated
+
+        if self.add_all is False:
+            return None
+        return {'name': name}
+
     def load(self, variable):
         """" Load and annotate a BIDSVariable
         Args:
             res - BIDSVariableCollection object
-        Returns a dictionary of annotated features
+        Returns a dictionary of annotated features, and a dictionary of
+        onset, duration and value arrays
         """
         if self.include is not None and variable.name not in self.include:
             return None
@@ -45,59 +118,50 @@ class PredictorSerializer(Serializer):
             return None
 
         annotated = {}
+        annotated['name'] = variable.name
         annotated['original_name'] = variable.name
         annotated['source'] = variable.source
 
-        for pattern, attr in self.schema.items():
-            if re.compile(pattern).match(variable.name):
-                annotated['name'] = re.sub(
-                    pattern, attr.pop('name'), variable.name) \
-                    if 'name' in attr else variable.name
-                annotated['description'] = re.sub(
-                    pattern, attr.pop('description'), variable.name) \
-                    if 'description' in attr else None
-                annotated.update(**attr)  # Add any additional attributes
-                break
-        else:
-            annotated['name'] = variable.name
-            if self.add_all is False:
-                return None
+        annotations = self.annotate(variable.name)
+        if annotations is None:
+            return None
+        annotated.update(annotations)
 
         # If SparseVariable
         if hasattr(variable, 'onset'):
-            onsets = variable.onset.tolist()
-            durations = variable.duration.tolist()
-            values = variable.values.values.tolist()
+            onsets = np.asarray(variable.onset, dtype=float)
+            durations = np.asarray(variable.duration, dtype=float)
+            values = variable.values.values
 
         # If Dense, resample, and sparsify
         else:
             TR = variable.sampling_rate / 2 if self.TR is None else self.TR
             variable = variable.resample(1 / TR)
 
-            onsets = np.arange(
-                0, len(variable.values) * self.TR, self.TR).tolist()
-            durations = [(self.TR)] * len(variable.values)
-            values = variable.values[variable.name].values.tolist()
-
-        events = []
-        for i, onset in enumerate(onsets):
-            try:
-                events.append(
-                    {
-                        'onset': onset,
-                        'duration': durations[i],
-                        'value': values[i]
-                    }
-                )
-            except IndexError:
-                if len(onsets) - len(values) == 1:
-                    pass
-                else:
-                    raise IndexError
+            values = variable.values[variable.name].values
+            onsets = np.arange(len(values)) * TR
+            durations = np.full(len(values), TR, dtype=float)
+
+        # Extra values are dropped, and there may be one extra onset
+        n_events = min(len(onsets), len(values))
+        if len(onsets) - n_events > 1:
+            raise ValueError(
+                "Variable {} has {} onsets, but only {} values".format(
+                    variable.name, len(onsets), len(values)))
+        events = {
+            'onset': onsets[:n_events],
+            'duration': durations[:n_events],
+            'value': values[:n_events]
+        }
 
         return annotated, events
 
 
+def _nullable(col):
+    """ Column values as a list, with None for missing values """
+    return col.astype(object).where(col.notnull(), None).tolist()
+
+
 stim_map = {
     'ImageStim': 'image',
     'VideoStim': 'video',
@@ -108,6 +172,9 @@ stim_map = {
 
 
 class FeatureSerializer(Serializer):
+    # Version of the serialized output format
+    VERSION = 2
+
     def __init__(self, add_all=True, object_id='all', splat=False,
                  round_n=None, resample_frequency=None):
         """
@@ -130,7 +197,8 @@ class FeatureSerializer(Serializer):
         super().__init__(current_app.config['FEATURE_SCHEMA'], add_all)
 
     def _annotate_feature(self, pattern, schema, feat, extractor, sub_df,
-                          default_active=True, resample_frequency=None):
+                          extractor_hash, default_active=True,
+                          resample_frequency=None):
         """ Annotate a single pliers extracted result
         Args:
             pattern - regex pattern to match feature name
@@ -138,79 +206,130 @@ class FeatureSerializer(Serializer):
             feat - feature name from pliers
             extractor - pliers extractor object
             sub_df - df with ef values
+            extractor_hash - hash of extractor
             default_active - set to active by default?
+        Returns a list of tuples of ExtractedFeature properties and
+        ExtractedEvent columns (dictionary of lists), one per feature
         """
-        # If name is in schema, substitue regex patterns from schema pattern
-        # and fill in format strings from extractor_dict
         feat = feat.replace(',', '')  # Remove commas
+        name, description = self.annotate_name(
+            pattern, schema, feat, extractor.__dict__)
+
+        if not resample_frequency:
+            resample_frequency = None
+
+        sub_df = sub_df[sub_df.value.notnull()].reset_index(drop=True)
+        if not self.splat and \
+           sub_df.value.map(lambda v: isinstance(v, list)).any():
+            raise ValueError("Value is an array and splatting is not True")
+
+        # Explode list values, one feature per position
+        sub_df['value'] = sub_df.value.map(
+            lambda v: v if isinstance(v, list) else [v])
+        lengths = sub_df.value.map(len)
+        sub_df = sub_df[lengths > 0].explode('value')
+        position = sub_df.groupby(level=0).cumcount() + 1
+        multiple = lengths[sub_df.index].values > 1
+
+        values = sub_df.value
+        if self.round_n is not None:
+            is_float = values.map(lambda v: isinstance(v, float))
+            if is_float.all():
+                values = values.astype(float).round(self.round_n)
+            else:
+                values = values.map(
+                    lambda v: round(v, self.round_n)
+                    if isinstance(v, float) else v)
+
+        events = {
+            'value': values.tolist(),
+            'onset': _nullable(sub_df['onset']),
+            'duration': _nullable(sub_df['duration']),
+            'object_id': _nullable(sub_df['object_id'])
+            if 'object_id' in sub_df else [None] * len(sub_df)
+        }
+        feature_names = np.where(
+            multiple, name + '_' + position.astype(str).values, name)
+
+        unique_names = pd.unique(feature_names)
+
+        annotated = []
+        for feature_name in unique_names:
+            feature_name = str(feature_name)
+            ef = {
+                'sha1_hash': hash_data(extractor_hash + feature_name),
+                'feature_name': feature_name,
+                'original_name': feat,
+                'description': description,
+                'active': schema.get('active', default_active),
+                'resample_frequency': resample_frequency
+                }
+            if len(unique_names) == 1:
+                ees = events
+            else:
+                ix = np.flatnonzero(feature_names == feature_name)
+                ees = {col: np.array(vals, dtype=object)[ix].tolist()
+                       for col, vals in events.items()}
+            annotated.append((ef, ees))
+        return annotated
+
+    @staticmethod
+    def annotate_name(pattern, schema, feat, attributes):
+        """ Annotate a feature name using the schema.
+        If name is in schema, substitue regex patterns from schema pattern
+        and fill in format strings from extractor attributes
+        Args:
+            pattern - regex pattern to match feature name
+            schema - sub-schema that matches feature name
+            feat - feature name from pliers
+            attributes - dictionary of extractor attributes
+        Returns tuple of feature name and description
+        """
+        regex = compile_pattern(pattern)
         if 'name' in schema:
-            name = re.sub(pattern, schema['name'], feat)
-            name = name.format(**extractor.__dict__)
+            name = regex.sub(schema['name'], feat).format(**attributes)
         else:
             name = feat
 
         if 'description' in schema:
-            description = re.sub(pattern, schema['description'], feat)
-            description = description.format(**extractor.__dict__)
+            description = regex.sub(
+                schema['description'], feat).format(**attributes)
         else:
             description = None
+        return name, description
 
-        if not resample_frequency:
-            resample_frequency = None
-
-        annotated = []
-        for _, row in sub_df[sub_df.value.notnull()].iterrows():
-            if isinstance(row['value'], list) and not self.splat:
-                raise ValueError("Value is an array and splatting is not True")
-            val = listify(row['value'])
-
-            for ix, v in enumerate(val):
-                feature_name = f"{name}_{ix+1}" if len(val) > 1 else name
-                if self.round_n is not None and isinstance(v, float):
-                    v = round(v, self.round_n)
-
-                ee = {
-                    'value': v,
-                    'onset': row['onset']
-                    if not pd.isnull(row['onset']) else None,
-                    'duration': row['duration']
-                    if not pd.isnull(row['duration']) else None,
-                    'object_id': row.get('object_id', None)
-                    }
-                ef = {
-                    'sha1_hash': hash_data(
-                        str(extractor.__hash__()) + feature_name),
-                    'feature_name': feature_name,
-                    'original_name': feat,
-                    'description': description,
-                    'active': schema.get('active', default_active),
-                    'resample_frequency': resample_frequency
-                    }
-
-                annotated.append((ee, ef))
-        return annotated
+    def extractor_schema(self, extractor_name, get_attribute):
+        """ Find matching extractor schema + attribute combination
+        Entries with no attributes will match any
+        Args:
+            extractor_name - name of extractor
+            get_attribute - function returning the value of an extractor
+                            attribute
+        """
+        ext_schema = {}
+        for candidate in self.schema.get(extractor_name, []):
+            for name, value in candidate.get("attributes", {}).items():
+                if get_attribute(name) != value:
+                    break
+            else:
+                ext_schema = candidate
+        return ext_schema
 
     def load(self, res):
         """" Load and annotate features in an extractor result object.
         Args:
             res - Pliers ExtractorResult object
 
-        Returns a dictionary of annotated features
+        Returns a list of tuples of ExtractedFeature properties and
+        ExtractedEvent columns (dictionary of lists)
         """
         res_df = res.to_df(format='long')
         if self.object_id == 'max':
             res_df = res_df[res_df.object_id == res_df.object_id.max()]
         features = res_df['feature'].unique().tolist()
 
-        # Find matching extractor schema + attribute combination
-        # Entries with no attributes will match any
-        ext_schema = {}
-        for candidate in self.schema.get(res.extractor.name, []):
-            for name, value in candidate.get("attributes", {}).items():
-                if getattr(res.extractor, name) != value:
-                    break
-            else:
-                ext_schema = candidate
+        ext_schema = self.extractor_schema(
+            res.extractor.name, lambda name: getattr(res.extractor, name))
 
         # Determine resample frequency. False value will skip
         resample_frequency = self.resample_frequency
@@ -221,15 +340,18 @@ class FeatureSerializer(Serializer):
         if resample_frequency:
             res_df = resample(res_df, resample_frequency)
 
+        extractor_hash = str(res.extractor.__hash__())
+        feature_dfs = dict(tuple(res_df.groupby('feature', sort=False)))
+
         annotated = []
         # Add all features in schema, popping features that match
         for pattern, schema in ext_schema.get('features', {}).items():
-            matching = list(filter(re.compile(pattern).match, features))
+            matching = list(filter(compile_pattern(pattern).match, features))
             features = set(features) - set(matching)
             for feat in matching:
                 annotated += self._annotate_feature(
                     pattern, schema, feat, res.extractor,
-                    res_df[res_df.feature == feat],
+                    feature_dfs[feat], extractor_hash,
                     resample_frequency=resample_frequency)
 
         # Add all remaining features
@@ -237,7 +359,7 @@ class FeatureSerializer(Serializer):
             for feat in features:
                 annotated += self._annotate_feature(
                     ".*", {}, feat, res.extractor,
-                    res_df[res_df.feature == feat], default_active=False,
+                    feature_dfs[feat], extractor_hash, default_active=False,
                     resample_frequency=resample_frequency)
 
         # Add extractor constants
@@ -251,7 +373,8 @@ class FeatureSerializer(Serializer):
             "modality": stim_map.get(res.extractor._input_type.__name__, '')
         }
 
-        for ee, ef in annotated:
+        for ef, _ in annotated:
             ef.update(constants)
 
         return annotated
+
@@ -14,6 +14,7 @@ from ..models import (
 from ..utils.core import listify
 from .utils import hash_stim
 from .ingest import add_stimulus
+from .prefetch import Prefetcher
 
 import pandas as pd
 from tqdm import tqdm
@@ -141,18 +142,22 @@ def create_new_stimuli(dataset_id, task_name, new_stims, rs_orig, parent_id=None
             dataset_name, task_name)
 
 
-def convert_stimuli(converters, dataset_name=None, task_name=None):
+def convert_stimuli(converters, dataset_name=None, task_name=None,
+                    prefetch=None, drop_after=False):
     """ Convert stimuli to different modality using pliers.
         Args:
             converters - dictionary of converter names to parameters
             dataset_name - dataset name
             task_name - task name
+            prefetch - If set, fetch the annexed files of this many upcoming
+                       stimuli in the background during conversion
+            drop_after - Drop prefetched files once they are converted
         Output:
             list of db ids of converted stimuli
     """
     if dataset_name is None:
         return [convert_stimuli(
-            converters, dataset.name, None)
+            converters, dataset.name, None, prefetch, drop_after)
                 for dataset in Dataset.query.filter_by(active=True)]
 
     dataset = Dataset.query.filter_by(name=dataset_name).one()
@@ -171,51 +176,68 @@ def convert_stimuli(converters, dataset_name=None, task_name=None):
 
     stim_objects = stim_objects.join(Dataset).filter_by(name=dataset_name)
 
+    stim_objects = stim_objects.all()
+
+    # Fetch stimulus files ahead of conversion
+    prefetcher = None
+    if prefetch:
+        prefetcher = Prefetcher(
+            [(stim.id, stim.path) for stim in stim_objects],
+            ahead=prefetch, drop_after=drop_after)
+        stim_objects = prefetcher.iter_ready(
+            stim_objects, key=lambda stim: stim.id)
+
     total_new_stims = []
-    # Extract new stimuli from original stimuli
-    for stim in stim_objects:
-        new_stims = []
-        # Re-create new RS associations with newly created stims
-        rs_orig = RunStimulus.query.filter_by(stimulus_id=stim.id).join(
-            Run).join(Task).filter_by(name=task_name)
-        loaded_stim = load_stims(stim.path)
-
-        # Extract for each converter
-        for graph in converters:
-            results = []
-            # Extract and flatten results (to a single unit)
-            conv = graph.roots[0].transformer
-            if conv._stim_matches_input_types(loaded_stim):
-                cstim = graph.transform(loaded_stim, merge=False)
-                if len(cstim) == 1:
-                    cstim = cstim[0]
-                params = str(conv.__dict__)
-                name = conv.name
-                try:  # Add iterable
-                    results += cstim
-                except TypeError:
-                    if hasattr(cstim, 'elements'):
-                        results += cstim.elements
-                    else:
-                        results.append(cstim)
-
-                results = [res for res in results
-                           if hasattr(res, 'data') and res.data != '']
-                new_stims += create_new_stimuli(
-                    dataset_id, task_name, results, rs_orig,
-                    parent_id=stim.id,
-                    transformer=name,
-                    transformer_params=params)
-
-        # De-activate previously generated stimuli from these converters.
-        update = Stimulus.query.filter_by(parent_id=stim.id).filter(
-            Stimulus.id.notin_(new_stims),
-            Stimulus.converter_name == conv.name,
-            Stimulus.converter_parameters == str(conv.__dict__))
-        if update.count():
-            update.update(dict(active=False), synchronize_session='fetch')
-        db.session.commit()
-        total_new_stims += new_stims
+    try:
+        # Extract new stimuli from original stimuli
+        for stim in stim_objects:
+            new_stims = []
+            # Re-create new RS associations with newly created stims
+            rs_orig = RunStimulus.query.filter_by(stimulus_id=stim.id).join(
+                Run).join(Task).filter_by(name=task_name)
+            loaded_stim = load_stims(stim.path)
+
+            # Extract for each converter
+            for graph in converters:
+                results = []
+                # Extract and flatten results (to a single unit)
+                conv = graph.roots[0].transformer
+                if conv._stim_matches_input_types(loaded_stim):
+                    cstim = graph.transform(loaded_stim, merge=False)
+                    if len(cstim) == 1:
+                        cstim = cstim[0]
+                    params = str(conv.__dict__)
+                    name = conv.name
+                    try:  # Add iterable
+                        results += cstim
+                    except TypeError:
+                        if hasattr(cstim, 'elements'):
+                            results += cstim.elements
+                        else:
+                            results.append(cstim)
+
+                    results = [res for res in results
+                               if hasattr(res, 'data') and res.data != '']
+                    new_stims += create_new_stimuli(
+                        dataset_id, task_name, results, rs_orig,
+                        parent_id=stim.id,
+                        transformer=name,
+                        transformer_params=params)
+
+            # De-activate previously generated stimuli from these converters.
+            update = Stimulus.query.filter_by(parent_id=stim.id).filter(
+                Stimulus.id.notin_(new_stims),
+                Stimulus.converter_name == conv.name,
+                Stimulus.converter_parameters == str(conv.__dict__))
+            if update.count():
+                update.update(dict(active=False), synchronize_session='fetch')
+            db.session.commit()
+            total_new_stims += new_stims
+            if prefetcher is not None:
+                prefetcher.release(stim.id)
+    finally:
+        if prefetcher is not None:
+            prefetcher.close()
 
     return total_new_stims
 
@@ -4,21 +4,39 @@ the associated predictors
 """
 from ..core import cache
 from ..database import db
-from .utils import tqdm_joblib, compute_pred_stats
+from .utils import (compute_pred_stats, extraction_cache_key,
+                    load_cached_result, save_cached_result, prune_cache,
+                    cached_result_exists, hash_data)
+import re
+import json
+import uuid
+from itertools import groupby, islice
+import queue
 import socket
+import threading
+import multiprocessing
+from concurrent.futures import (ThreadPoolExecutor, wait, as_completed,
+                                FIRST_COMPLETED)
+from types import SimpleNamespace
+from flask import current_app
 
 from pathlib import Path
 from tqdm import tqdm
-from joblib import Parallel, delayed, parallel_backend
-from ..utils.db import get_or_create
+from ..utils.db import (get_or_create, materialize_pes,
+                        update_latest_predictors, bulk_insert)
+from sqlalchemy import select, func, distinct
+from sqlalchemy.orm import aliased
+from sqlalchemy.dialects.postgresql import insert
 
 import pliers as pl
 from pliers.stimuli import load_stims, ComplexTextStim, TextStim
 from pliers.graph import Graph
 from ..models import (
     Dataset, Task, Predictor, PredictorRun, Run, Stimulus,
-    RunStimulus, ExtractedFeature, ExtractedEvent)
+    RunStimulus, ExtractedFeature, ExtractedEvent, ExtractionCheckpoint)
 from .annotate import FeatureSerializer
+from .remote import RemoteLimiter, graph_provider
+from .prefetch import Prefetcher
 
 
 socket.setdefaulttimeout(10000)
@@ -40,6 +58,63 @@ def _load_stim(stim_model):
     return stims
 
 
+def _graph_mimetypes(graph):
+    """ Mimetype patterns of stimuli that a graph can be applied to """
+    it = graph.roots[0].transformer._input_type
+    if not isinstance(list, it):
+        it = list([it])
+    return [str(i).split('.')[-2] for i in it]
+
+
+def _graph_extractor(graph):
+    """ Extractor producing the (first) result of a graph """
+    node = graph.roots[0]
+    while node.children:
+        node = node.children[0]
+    return node.transformer
+
+
+def _extractor_signature(extractor):
+    """ Extractor name, parameters and version, as stored in
+    ExtractedFeature """
+    tr_attrs = [getattr(extractor, a) for a in extractor._log_attributes]
+    return (extractor.name,
+            str(dict(zip(extractor._log_attributes, tr_attrs))),
+            float(extractor.VERSION))
+
+
+def _plan_extraction(stims, graphs):
+    """ Find the graphs that have not yet been applied to each stimulus
+    Args:
+        stims - list of Stimulus models
+        graphs - list of pliers Graphs
+    Returns:
+        list of tuples of Stimulus model and list of graphs to apply
+    """
+    signatures = [_extractor_signature(_graph_extractor(g)) for g in graphs]
+    existing = set(
+        (stim_id, name, params, version)
+        for stim_id, name, params, version in db.session.query(
+            ExtractedEvent.stimulus_id, ExtractedFeature.extractor_name,
+            ExtractedFeature.extractor_parameters,
+            ExtractedFeature.extractor_version).join(ExtractedFeature).filter(
+                ExtractedEvent.stimulus_id.in_([s.id for s in stims]),
+                ExtractedFeature.extractor_name.in_(
+                    set(sig[0] for sig in signatures))).distinct()
+    )
+
+    plan = []
+    for stim in stims:
+        missing = [
+            g for g, sig in zip(graphs, signatures)
+            if (stim.id, ) + sig not in existing
+            and re.search('|'.join(_graph_mimetypes(g)), stim.mimetype)
+        ]
+        if missing:
+            plan.append((stim, missing))
+    return plan
+
+
 def _query_stim_models(dataset_name, task_name=None, graphs=None):
     """ Given a dataset and task, query all matching stimuli.
     Optionally a list of graphs can be provided which further restrict
@@ -50,13 +125,7 @@ def _query_stim_models(dataset_name, task_name=None, graphs=None):
 
     # Determine the necessary stimuli to load
     if graphs is not None:
-        mimetypes = []
-        for g in graphs:
-            it = g.roots[0].transformer._input_type
-            if not isinstance(list, it):
-                it = list([it])
-            for i in it:
-                mimetypes.append(str(i).split('.')[-2])
+        mimetypes = [m for g in graphs for m in _graph_mimetypes(g)]
         stim_models = stim_models.filter(
             Stimulus.mimetype.op('~')('|'.join(mimetypes)))
 
@@ -73,66 +142,147 @@ def _query_stim_models(dataset_name, task_name=None, graphs=None):
     return stim_models
 
 
-def _extract_to_serial(graphs, stim_object, serializer):
-    """ For a stim_object, load stim and apply graphs, and serialize """
+def _transform(graph, stim):
+    """ Apply a graph to a pliers stim """
+    try:
+        return graph.transform(stim, merge=False)
+    except Exception:
+        # Try again (may be connection error)
+        return graph.transform(stim, merge=False)
+
+
+def _extract_to_serial(graphs, stim_object, serializer, cache_dir=None,
+                       transform=_transform):
+    """ For a stim_object, load stim and apply graphs, and serialize.
+    If cache_dir is given, serialized results are read from and saved to
+    the extraction cache, and the stim is only loaded on a cache miss.
+    Graphs are applied using transform(graph, stim) """
     results = []
-    for stim_obj, pliers_stim in _load_stim(stim_object):
-        # For each graph, check compatability, and then extract
-        for graph in graphs:
+    pending = []
+    for graph in graphs:
+        key = None
+        if cache_dir is not None:
+            key = extraction_cache_key(
+                stim_object.sha1_hash, graph, serializer)
+            cached = load_cached_result(cache_dir, key)
+            if cached is not None:
+                results += [(stim_object.id, res) for res in cached]
+                continue
+        pending.append((graph, key))
+
+    if not pending:
+        return results
+
+    stims = _load_stim(stim_object)
+    for graph, key in pending:
+        graph_results = []
+        for stim_obj, pliers_stim in stims:
+            # For each graph, check compatability, and then extract
             ext = graph.roots[0].transformer
             if ext._stim_matches_input_types(pliers_stim):
                 # Hacky workaround. Look for compatible AVI
                 if 'GoogleVideoAPIShotDetectionExtractor' in str(ext.__class__):
                     pliers_stim.filename = str(
                         Path(pliers_stim.filename).with_suffix('.avi'))
-                try:
-                    res = graph.transform(pliers_stim, merge=False)[0]
-                except Exception:
-                    # Try again (may be connection error)
-                    res = graph.transform(pliers_stim, merge=False)[0]
-                res = serializer.load(res)
-                results.append((stim_obj.id, res))
+                res = transform(graph, pliers_stim)[0]
+                graph_results.append(serializer.load(res))
+
+        if key is not None:
+            save_cached_result(cache_dir, key, graph_results)
+        results += [(stim_object.id, res) for res in graph_results]
     return results
 
 
-def _create_efs(results):
+def _is_cached(stim_object, graphs, serializer, cache_dir=None):
+    """ Whether the results of all graphs for a stim_object are cached """
+    return cache_dir is not None and all(
+        cached_result_exists(cache_dir, extraction_cache_key(
+            stim_object.sha1_hash, graph, serializer))
+        for graph in graphs)
+
+
+def _create_efs(results, existing=None, ext_feats=None, progress=True,
+                commit=True):
     """ Create ExtractedFeature models from Pliers results.
         Only creates one object per unique feature
     Args:
-        results - list of zipped pairs of Stimulus objects and ExtractedResult
-                  objects
+        results - list of zipped pairs of Stimulus ids and serialized
+                  results (see FeatureSerializer.load)
+        existing - optional dictionary of feature signatures (see
+                   _feature_signature) to ExtractedFeature models to add new
+                   events to, instead of creating new features
+        ext_feats - optional dictionary of features created by previous
+                    calls (when writing results in batches). Updated in place
+        progress - show progress bar
+        commit - commit session. Otherwise, all models are only flushed
     Returns:
-        ext_feats - dictionary of hash of ExtractedFeatures to EF objects
+        ext_feats - dictionary of feature signatures to EF objects
     """
-    ext_feats = {}
+    ext_feats = {} if ext_feats is None else ext_feats
     bulk_ees = []
+    existing = existing or {}
 
-    print("Creating ExtractedFeatures...")
-    for stim_id, ser in tqdm(results):
-        for ee_props, ef_props in ser:
-            # Hash extractor name + feature name
-            feat_hash = ef_props['sha1_hash']
+    if progress:
+        print("Creating ExtractedFeatures...")
+    for stim_id, ser in tqdm(results, disable=not progress):
+        for ef_props, ees in ser:
+            # sha1_hash differs between results extracted and cached by
+            # different processes, so features are keyed by signature
+            signature = _feature_signature(ef_props)
 
             # If we haven't already added this feature
-            if feat_hash not in ext_feats:
-                # Create/get feature
-                ef_model = ExtractedFeature(**ef_props)
-                db.session.add(ef_model)
-                db.session.commit()
-                ext_feats[feat_hash] = ef_model
+            if signature not in ext_feats:
+                ef_model = existing.get(signature)
+                if ef_model is None:
+                    # Create/get feature
+                    ef_model = ExtractedFeature(**ef_props)
+                    db.session.add(ef_model)
+                    if commit:
+                        db.session.commit()
+                    else:
+                        db.session.flush()
+                ext_feats[signature] = ef_model
 
             # Create ExtractedEvents
-            bulk_ees.append(
-                dict(stimulus_id=stim_id, ef_id=ext_feats[feat_hash].id, 
-                    **ee_props))
-    db.session.execute(ExtractedEvent.__table__.insert(), bulk_ees)
-    db.session.commit()
+            ef_id = ext_feats[signature].id
+            bulk_ees += [
+                dict(stimulus_id=stim_id, ef_id=ef_id, onset=onset,
+                     duration=duration, value=value, object_id=object_id)
+                for onset, duration, value, object_id in zip(
+                    ees['onset'], ees['duration'], ees['value'],
+                    ees['object_id'])
+            ]
+    bulk_insert(ExtractedEvent.__table__, bulk_ees)
+    if commit:
+        db.session.commit()
 
     return ext_feats
 
 
+def _feature_signature(ef):
+    """ Properties identifying a feature across extractions (sha1_hash
+    is not stable across processes) """
+    if isinstance(ef, dict):
+        ef = SimpleNamespace(**ef)
+    version = ef.extractor_version
+    return (ef.extractor_name, ef.extractor_parameters,
+            float(version) if version is not None else None,
+            ef.feature_name, ef.resample_frequency)
+
+
+def _existing_features(dataset_name):
+    """ Newest ExtractedFeature of each signature with events for
+    the stimuli of a dataset """
+    ef_ids = db.session.query(ExtractedEvent.ef_id).join(Stimulus).join(
+        Dataset).filter(Dataset.name == dataset_name).distinct()
+    efs = ExtractedFeature.query.filter(
+        ExtractedFeature.id.in_(ef_ids)).order_by(ExtractedFeature.id)
+    return {_feature_signature(ef): ef for ef in efs}
+
+
 def create_predictors(features, dataset_name, task_name=None, run_ids=None,
-                      percentage_include=.9, clear_cache=True):
+                      percentage_include=.9, clear_cache=True,
+                      materialize=False, pr_batch_size=100):
     """ Create Predictors from Extracted Features.
         Args:
             features (object) - ExtractedFeature objects
@@ -141,6 +291,11 @@ def create_predictors(features, dataset_name, task_name=None, run_ids=None,
             run_ids (list of ints) - Optional list of run_ids for which to
                                      create PredictorRun for.
             clear_cache (bool) - Clear API cache
+            materialize (bool) - Materialize PredictorEvents of new
+                                 Predictors. Predictors that are already
+                                 materialized are always refreshed.
+            pr_batch_size (int) - Number of Predictors to create
+                                  PredictorRuns for per statement
     """
     print("Creating predictors")
 
@@ -156,52 +311,92 @@ def create_predictors(features, dataset_name, task_name=None, run_ids=None,
     else:
         n_runs = len(dataset.runs)
 
+    # Calculate num of runs each feature is present in
+    if percentage_include:
+        coverage = dict(db.session.query(
+            ExtractedEvent.ef_id, func.count(distinct(RunStimulus.run_id))).\
+            join(RunStimulus,
+                 RunStimulus.stimulus_id == ExtractedEvent.stimulus_id).\
+            filter(ExtractedEvent.ef_id.in_([ef.id for ef in features])).\
+            group_by(ExtractedEvent.ef_id))
+
     # Create/Get Predictors
     all_preds = []
     for ef in features:
         create = True
         if percentage_include:
-            # Calculate num of runs this feature is present in
-            unique_runs = RunStimulus.query.filter(
-                RunStimulus.stimulus_id.in_(
-                    set([ee.stimulus_id for ee in ef.extracted_events]))).\
-                    distinct('run_id')
-            create = unique_runs.count() / n_runs > percentage_include
+            create = coverage.get(ef.id, 0) / n_runs > percentage_include
         all_preds.append(get_or_create(
             Predictor, name=ef.feature_name, description=ef.description,
             dataset_id=dataset.id,
             source='extracted', ef_id=ef.id)[0])
 
-    # Create PredictorRuns
-    for ix, predictor in enumerate(tqdm(all_preds)):
-        ef = features[ix]
-        all_rs = []
-        # For all instances for stimuli in this set of runs
-        for ee in ef.extracted_events:
-            query = RunStimulus.query.filter_by(stimulus_id=ee.stimulus_id)
-            if run_ids is not None:
-                query = query.filter(RunStimulus.run_id.in_(run_ids))
-            all_rs += [(predictor.id, rs.run_id) for rs in query]
-
-        all_rs = [dict(predictor_id=pred_id, run_id=run_id)
-                  for pred_id, run_id in set(all_rs)]
-        db.session.execute(PredictorRun.__table__.insert(), all_rs)
-        db.session.commit()
-        
+    # Create PredictorRuns, for all runs with stimuli of each feature
+    pr_table = PredictorRun.__table__
+    for ix in tqdm(range(0, len(all_preds), pr_batch_size)):
+        pred_ids = [p.id for p in all_preds[ix:ix + pr_batch_size]]
+        # Only runs of this dataset, as features may be shared across
+        # datasets (e.g. by stimuli with identical content)
+        source = Predictor.__table__.join(
+            ExtractedEvent.__table__,
+            ExtractedEvent.ef_id == Predictor.ef_id).join(
+                RunStimulus.__table__,
+                RunStimulus.stimulus_id == ExtractedEvent.stimulus_id).join(
+                    Run.__table__, Run.id == RunStimulus.run_id)
+        query = select([Predictor.id, RunStimulus.run_id]).distinct().\
+            select_from(source).where(
+                Predictor.id.in_(pred_ids) & (Run.dataset_id == dataset.id))
+        if run_ids is not None:
+            query = query.where(RunStimulus.run_id.in_(run_ids))
+
+        # Predictors may already have runs, if events were added to them
+        db.session.execute(
+            insert(pr_table).from_select(
+                ['predictor_id', 'run_id'], query).on_conflict_do_nothing(
+                    index_elements=['run_id', 'predictor_id']))
+
+    # Newest Predictors are looked up through their runs, so they are
+    # updated in the same transaction
+    update_latest_predictors([p.id for p in all_preds], commit=False)
+    db.session.commit()
+
     # Compute metrics
-    for pred in all_preds:
-        compute_pred_stats(db.session, pred, commit=True)
+    compute_pred_stats(db.session, [p.id for p in all_preds], commit=True)
+
+    # Refresh materialized PredictorEvents for these runs
+    refresh_ids = [p.id for p in all_preds if p.materialized]
+    new_ids = [p.id for p in all_preds if not p.materialized]
+    if refresh_ids:
+        materialize_pes(refresh_ids, run_ids)
+    if materialize and new_ids:
+        materialize_pes(new_ids)
 
     return [p.id for p in all_preds]
 
 
 def extract_features(graphs, dataset_name=None, task_name=None, n_jobs=1,
+                     use_cache=True, incremental=False, batch_size=10000,
+                     remote_threads=None, prefetch=None, drop_after=False,
                      **serializer_kwargs):
     """ Extract features using pliers for a dataset/task
         Args:
             graphs - List of Graphs to apply to stimuli
             dataset_name - dataset name (optional;)
             task_name - task name (optional)
+            use_cache - Read and save results in the extraction cache
+            incremental - Only apply graphs to stimuli that have no events
+                          from the same extractor, and add new events to
+                          existing Predictors
+            batch_size - Number of ExtractedEvents to write at a time.
+                         Progress is checkpointed after each batch, and an
+                         interrupted extraction resumes from the checkpoint
+            remote_threads - If set, extract stimuli in this many threads
+                             (instead of n_jobs processes), for graphs that
+                             call remote APIs. Calls are limited per
+                             provider (see REMOTE_EXTRACTORS config)
+            prefetch - If set, fetch the annexed files of this many upcoming
+                       stimuli in the background during extraction
+            drop_after - Drop prefetched files once they are extracted
             serializer_kwargs - Arguments to pass to FeatureSerializer
         Output:
             list of db ids of extracted features
@@ -211,97 +406,582 @@ def extract_features(graphs, dataset_name=None, task_name=None, n_jobs=1,
     # If no dataset is specified extract for all datasets recursively
     if dataset_name is None:
         return [extract_features(
-            graphs, dataset.name, None, **serializer_kwargs)
+            graphs, dataset.name, None, n_jobs, use_cache, incremental,
+            batch_size, remote_threads, prefetch, drop_after,
+            **serializer_kwargs)
                 for dataset in Dataset.query.filter_by(active=True)]
 
     # Load Pliers Graph objects
+    graph_specs = graphs
     graphs = [Graph(g) for g in graphs]
 
     stims = _query_stim_models(dataset_name, task_name, graphs=graphs)
 
-    # Apply graphs to each stim_object in parallel
-    with parallel_backend('multiprocessing'):
-        with tqdm_joblib(tqdm(desc="Extracting...", total=len(stims))):
-            results = Parallel(n_jobs=n_jobs)(
-                delayed(_extract_to_serial)(
-                    graphs, s, serializer) for s in stims)
-
-    # Flatten
-    results = [item for sublist in results for item in sublist]
-
-    if not results:
+    if incremental:
+        plan = _plan_extraction(stims, graphs)
+        if not plan:
+            print("All stimuli already extracted")
+            return []
+    else:
+        plan = [(s, graphs) for s in stims]
+
+    cache_dir = current_app.config['EXTRACTION_CACHE'] if use_cache else None
+
+    # Resume from an interrupted extraction of the same graphs
+    checkpoint = _load_checkpoint(
+        _checkpoint_key(graph_specs, dataset_name, task_name, incremental,
+                        serializer_kwargs),
+        _plan_hash(stims, serializer))
+    if checkpoint.stimuli:
+        print("Resuming, {} stimuli already extracted".format(
+            len(checkpoint.stimuli)))
+    done = set(checkpoint.stimuli)
+    plan = [(s, g) for s, g in plan if s.id not in done]
+
+    existing = _existing_features(dataset_name) if incremental else {}
+    existing.update({
+        _feature_signature(ef): ef for ef in ExtractedFeature.query.filter(
+            ExtractedFeature.id.in_(checkpoint.features))
+    })
+
+    # Apply graphs to each stim_object in parallel, writing results in
+    # batches as they arrive
+    ext_feats = {}
+    batch, batch_stims, n_events = [], [], 0
+    n_plan = len(plan)
+    prefetcher, max_pending = None, None
+    if prefetch:
+        # Stimuli with fully cached results are not fetched
+        prefetcher = Prefetcher(
+            [(stim.id, None if _is_cached(
+                stim, stim_graphs, serializer, cache_dir) else stim.path)
+             for stim, stim_graphs in plan],
+            ahead=prefetch, drop_after=drop_after)
+        plan = prefetcher.iter_ready(plan, key=lambda p: p[0].id)
+        # Stimuli in flight hold prefetch slots until they are released
+        max_pending = prefetch
+
+    try:
+        with tqdm(desc="Extracting...", total=n_plan) as progress:
+            if remote_threads:
+                extractions = _iter_remote_extractions(
+                    plan, serializer, cache_dir, remote_threads, graph_specs,
+                    graphs, max_pending=max_pending)
+            else:
+                extractions = _iter_extractions(
+                    plan, serializer, cache_dir, n_jobs, max_pending,
+                    graph_specs=graph_specs, graphs=graphs)
+            for stim_id, results in extractions:
+                if prefetcher is not None:
+                    prefetcher.release(stim_id)
+                batch += results
+                batch_stims.append(stim_id)
+                n_events += sum(
+                    len(ees['value']) for _, ser in results for _, ees in ser)
+                progress.update()
+                if n_events >= batch_size:
+                    _write_batch(batch, batch_stims, existing, ext_feats,
+                                 checkpoint)
+                    batch, batch_stims, n_events = [], [], 0
+            _write_batch(batch, batch_stims, existing, ext_feats, checkpoint)
+    finally:
+        if prefetcher is not None:
+            prefetcher.close()
+
+    if cache_dir is not None:
+        prune_cache(cache_dir, current_app.config.get(
+            'EXTRACTION_CACHE_SIZE', 10 * 1024 ** 3))
+
+    features = {
+        ef.id: ef for ef in ExtractedFeature.query.filter(
+            ExtractedFeature.id.in_(checkpoint.features))}
+    if not features:
+        _clear_checkpoint(checkpoint.key)
         raise ValueError("No features could be extracted")
 
-    # Insert resultsw to db as ExtractedFeatures
-    ext_feats = _create_efs(results)
-
     # Create Predictors for ExtractedFeatures
-    return create_predictors(
-        [ef for ef in ext_feats.values() if ef.active],
+    pred_ids = create_predictors(
+        [ef for ef in features.values() if ef.active],
         dataset_name, task_name)
+    _clear_checkpoint(checkpoint.key)
+
+    return pred_ids
+
+
+def _iter_extractions(plan, serializer, cache_dir=None, n_jobs=1,
+                      max_pending=None, graph_specs=None, graphs=None):
+    """ Apply graphs to stimuli, yielding results as they are completed.
+    Args:
+        plan - list of tuples of Stimulus model and graphs to apply
+        serializer - FeatureSerializer
+        cache_dir - extraction cache directory
+        n_jobs - number of worker processes
+        max_pending - maximum number of stimuli being extracted or waiting to
+                      be consumed. Defaults to 4 per worker
+        graph_specs - Graph specs that worker processes load graphs from,
+                      once per worker...
+        graphs - ...in the same order as these Graphs in the plan
+    Yields:
+        tuples of Stimulus id and serialized results
+    """
+    if n_jobs == 1:
+        for stim, stim_graphs in plan:
+            yield stim.id, _extract_to_serial(
+                stim_graphs, stim, serializer, cache_dir)
+        return
+
+    if n_jobs < 0:
+        n_jobs = max(multiprocessing.cpu_count() + 1 + n_jobs, 1)
+    if max_pending is None:
+        max_pending = 4 * n_jobs
+
+    with multiprocessing.Pool(
+      n_jobs, initializer=_init_worker,
+      initargs=(graph_specs, serializer, cache_dir)) as pool:
+        yield from _imap_bounded(
+            pool, _extract_in_worker,
+            ((_stim_payload(stim), [graphs.index(g) for g in stim_graphs])
+             for stim, stim_graphs in plan),
+            max_pending)
+
+
+def _iter_remote_extractions(plan, serializer, cache_dir, n_threads,
+                             graph_specs, graphs, max_pending=None):
+    """ Apply remote API graphs to stimuli in a thread pool, yielding results
+    as they are completed. Each thread loads its own graphs, and API calls
+    are limited per provider.
+    Args:
+        plan - list of tuples of Stimulus model and graphs to apply
+        serializer - FeatureSerializer
+        cache_dir - extraction cache directory
+        n_threads - number of threads
+        graph_specs - Graph specs that threads load graphs from...
+        graphs - ...in the same order as these Graphs in the plan
+        max_pending - maximum number of stimuli being extracted or waiting to
+                      be consumed. Defaults to 4 per thread
+    Yields:
+        tuples of Stimulus id and serialized results
+    """
+    limiter = RemoteLimiter.from_config(
+        current_app.config.get('REMOTE_EXTRACTORS', {}))
+    local = threading.local()
+
+    def transform(graph, stim):
+        return limiter.call(
+            graph_provider(graph), graph.transform, stim, merge=False)
+
+    def extract(payload, graph_ix):
+        if not hasattr(local, 'graphs'):
+            local.graphs = [Graph(g) for g in graph_specs]
+        stim = _payload_stim(payload)
+        return stim.id, _extract_to_serial(
+            [local.graphs[ix] for ix in graph_ix], stim, serializer,
+            cache_dir, transform=transform)
+
+    if max_pending is None:
+        max_pending = 4 * n_threads
+
+    pending = set()
+    with ThreadPoolExecutor(n_threads) as executor:
+        for stim, stim_graphs in plan:
+            while len(pending) >= max_pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+            pending.add(executor.submit(
+                extract, _stim_payload(stim),
+                [graphs.index(g) for g in stim_graphs]))
+        for future in as_completed(pending):
+            yield future.result()
+
+
+def _imap_bounded(pool, func, tasks, max_pending):
+    """ Apply a function to tasks in a pool, yielding results as they are
+    completed. The number of tasks in flight is bounded, so completed
+    results can't pile up in memory faster than they are consumed """
+    done = queue.Queue()
+    pending = 0
+    for args in tasks:
+        while pending >= max_pending:
+            yield _get_extraction(done)
+            pending -= 1
+        pool.apply_async(
+            func, args, callback=done.put, error_callback=done.put)
+        pending += 1
+    while pending:
+        yield _get_extraction(done)
+        pending -= 1
+
+
+# Graphs, serializer and cache directory of an extraction worker process
+_worker = None
+
+
+def _init_worker(graph_specs, serializer, cache_dir):
+    """ Load graphs once per extraction worker process """
+    global _worker
+    _worker = SimpleNamespace(
+        graphs=[Graph(g) for g in graph_specs], serializer=serializer,
+        cache_dir=cache_dir)
+
+
+def _stim_payload(stim):
+    """ Stimulus attributes needed for extraction, to send to workers
+    instead of the Stimulus model """
+    return (stim.id, stim.path, stim.content, stim.mimetype, stim.sha1_hash)
+
+
+def _payload_stim(payload):
+    """ Stimulus-like object from a stimulus payload """
+    stim_id, path, content, mimetype, sha1_hash = payload
+    return SimpleNamespace(
+        id=stim_id, path=path, content=content, mimetype=mimetype,
+        sha1_hash=sha1_hash)
+
+
+def _extract_in_worker(payload, graph_ix):
+    """ Apply graphs (by index) to a stimulus payload in a worker """
+    stim = _payload_stim(payload)
+    return stim.id, _extract_to_serial(
+        [_worker.graphs[ix] for ix in graph_ix], stim, _worker.serializer,
+        _worker.cache_dir)
+
+
+def _get_extraction(done):
+    """ Get next completed extraction, re-raising worker errors """
+    res = done.get()
+    if isinstance(res, Exception):
+        raise res
+    return res
+
+
+def _write_batch(batch, batch_stims, existing, ext_feats, checkpoint):
+    """ Write a batch of extraction results, and checkpoint progress in the
+    same transaction """
+    _create_efs(batch, existing=existing, ext_feats=ext_feats,
+                progress=False, commit=False)
+    checkpoint.stimuli = checkpoint.stimuli + batch_stims
+    checkpoint.features = sorted(
+        set(checkpoint.features) | set(ef.id for ef in ext_feats.values()))
+    db.session.add(checkpoint)
+    db.session.commit()
+
+
+def dispatch_extraction(graphs, dataset_name, task_name=None,
+                        incremental=False, use_cache=True,
+                        **serializer_kwargs):
+    """ Extract features on celery workers, with one task per
+    (stimulus, graph) unit. Once all units finish, a chord callback
+    creates Predictors for the extracted features.
+        Args:
+            graphs - List of Graphs specs to apply to stimuli
+            dataset_name - dataset name
+            task_name - task name (optional)
+            incremental - Only dispatch units for stimuli that have no
+                          events from the same extractor
+            use_cache - Read and save results in the extraction cache
+            serializer_kwargs - Arguments to pass to FeatureSerializer
+        Output:
+            celery AsyncResult of the chord
+    """
+    from celery import chord
+    from ..worker import celery_app
+
+    pl_graphs = [Graph(g) for g in graphs]
+    stims = _query_stim_models(dataset_name, task_name, graphs=pl_graphs)
+    if incremental:
+        plan = _plan_extraction(stims, pl_graphs)
+    else:
+        plan = [(s, pl_graphs) for s in stims]
+
+    # Units of this extraction share the features they create
+    extraction_id = uuid.uuid4().hex
+    units = [
+        celery_app.signature(
+            'extraction.extract_unit',
+            args=[stim.id, graphs[pl_graphs.index(g)], extraction_id,
+                  use_cache, serializer_kwargs])
+        for stim, stim_graphs in plan for g in stim_graphs
+    ]
+    if not units:
+        raise ValueError("No stimuli to extract")
+
+    return chord(units)(celery_app.signature(
+        'extraction.create_predictors', args=[dataset_name, task_name]))
+
+
+def _lock_feature(ef_props, extraction_id):
+    """ Get or create the ExtractedFeature of an extraction unit.
+    Features are locked until the end of the transaction, so concurrent
+    units of the same extraction create each feature once """
+    signature = _feature_signature(ef_props)
+    db.session.execute(select([func.pg_advisory_xact_lock(
+        func.hashtext(str((extraction_id, ) + signature)))]))
+
+    version = ef_props.get('extractor_version')
+    ef = ExtractedFeature.query.filter_by(
+        extraction_id=extraction_id,
+        extractor_name=ef_props['extractor_name'],
+        extractor_parameters=ef_props['extractor_parameters'],
+        extractor_version=float(version) if version is not None else None,
+        feature_name=ef_props['feature_name'],
+        resample_frequency=ef_props['resample_frequency']).first()
+    if ef is None:
+        ef = ExtractedFeature(extraction_id=extraction_id, **ef_props)
+        db.session.add(ef)
+        db.session.flush()
+    return ef
+
+
+def write_extraction_unit(stim_id, results, extraction_id):
+    """ Write the results of an extraction unit. Writes are idempotent:
+    events previously written for the same stimulus and features (e.g. by
+    a failed attempt) are replaced.
+        Args:
+            stim_id - Stimulus id
+            results - serialized results (see FeatureSerializer.load)
+            extraction_id - id of the dispatched extraction
+        Output:
+            list of ids of ExtractedFeatures
+    """
+    # Lock features in a consistent order, to avoid deadlocks
+    annotated = sorted(
+        [(ef_props, ees) for _, ser in results for ef_props, ees in ser],
+        key=lambda r: str(_feature_signature(r[0])))
+
+    ef_ids, bulk_ees = [], []
+    for ef_props, ees in annotated:
+        ef_id = _lock_feature(ef_props, extraction_id).id
+        ef_ids.append(ef_id)
+        bulk_ees += [
+            dict(stimulus_id=stim_id, ef_id=ef_id, onset=onset,
+                 duration=duration, value=value, object_id=object_id)
+            for onset, duration, value, object_id in zip(
+                ees['onset'], ees['duration'], ees['value'],
+                ees['object_id'])
+        ]
+
+    ExtractedEvent.query.filter(
+        ExtractedEvent.stimulus_id == stim_id,
+        ExtractedEvent.ef_id.in_(ef_ids)).delete(synchronize_session=False)
+    bulk_insert(ExtractedEvent.__table__, bulk_ees)
+    db.session.commit()
+
+    return sorted(set(ef_ids))
+
+
+def _checkpoint_key(graph_specs, dataset_name, task_name, incremental,
+                    serializer_kwargs):
+    """ Identify an extraction job, to resume it after an interruption """
+    return hash_data(json.dumps(
+        [dataset_name, task_name, incremental, graph_specs,
+         serializer_kwargs], sort_keys=True, default=str))
+
+
+def _plan_hash(stims, serializer):
+    """ Hash of the stimuli and schema an extraction job applies to """
+    return hash_data(json.dumps(
+        [sorted(s.id for s in stims), serializer.schema_hash]))
+
+
+def _load_checkpoint(key, plan_hash):
+    """ Load extraction checkpoint: ids of extracted stimuli and created
+    ExtractedFeatures. Checkpoints of a different plan (e.g. stimuli were
+    since ingested, or the schema changed) are discarded """
+    checkpoint = ExtractionCheckpoint.query.get(key)
+    if checkpoint is not None and checkpoint.plan_hash != plan_hash:
+        print("Stimuli or schema changed since the interrupted extraction, "
+              "discarding its checkpoint")
+        db.session.delete(checkpoint)
+        db.session.commit()
+        checkpoint = None
+    if checkpoint is None:
+        checkpoint = ExtractionCheckpoint(
+            key=key, plan_hash=plan_hash, stimuli=[], features=[])
+    return checkpoint
+
+
+def _clear_checkpoint(key):
+    ExtractionCheckpoint.query.filter_by(key=key).delete()
+    db.session.commit()
 
 
 def _load_complex_text_stim_models(dataset_name, task_name=None):
     """ Reconstruct ComplexTextStim object of complete run transcript
-    for each run in a task """
-    stim_models = Stimulus.query.filter_by(
-        active=True, mimetype='text/csv').join(
-            RunStimulus).join(Run).join(Task)
-        
+    for each run in a task, from a single query of the words in each
+    transcript's run """
+    transcript_rs = aliased(RunStimulus)
+    word_rs = aliased(RunStimulus)
+    word = aliased(Stimulus)
+
+    # Each transcript is reconstructed from its first run
+    first_rs = db.session.query(func.min(RunStimulus.id)).group_by(
+        RunStimulus.stimulus_id)
+
+    onset = (word_rs.onset - transcript_rs.onset).label('onset')
+    rows = db.session.query(
+        Stimulus.id, word.content, onset, word_rs.duration).filter(
+            Stimulus.active.is_(True), Stimulus.mimetype == 'text/csv').join(
+            transcript_rs, transcript_rs.stimulus_id == Stimulus.id).filter(
+            transcript_rs.id.in_(first_rs)).join(
+            Run, Run.id == transcript_rs.run_id).join(
+            Task, Task.id == Run.task_id)
+
     if task_name is not None:
-        stim_models = stim_models.filter_by(name=task_name)
-        
-    stim_models = stim_models.join(Dataset).filter_by(name=dataset_name)
+        rows = rows.filter(Task.name == task_name)
+
+    rows = rows.join(Dataset, Dataset.id == Task.dataset_id).filter(
+        Dataset.name == dataset_name).join(
+        word_rs, word_rs.run_id == transcript_rs.run_id).join(
+        word, word.id == word_rs.stimulus_id).filter(
+            word.mimetype == 'text/plain').order_by(
+                Stimulus.id, onset, word_rs.id)
 
-    stims = []
     print("Loading stim models...")
-    for stim_model in tqdm(stim_models):
-        # Reconstruct complete ComplexTextStim
-        rs_transcript = stim_model.run_stimuli.first()
-        run_words = Stimulus.query.filter_by(
-            mimetype='text/plain').join(RunStimulus).filter_by(
-                run_id=rs_transcript.run_id)
-
-        word_stims = []
-        for w in run_words:
-            for w_rs in w.run_stimuli.filter_by(run_id=rs_transcript.run_id):
-                word_stims.append(
-                    TextStim(
-                        text=w.content, onset=w_rs.onset-rs_transcript.onset,
-                        duration=w_rs.duration)
-                    )
-        word_stims = sorted(word_stims, key=lambda x: x.onset)
-        stims.append((stim_model, ComplexTextStim(elements=word_stims)))
+    transcripts = [
+        (stim_id, ComplexTextStim(elements=[
+            TextStim(text=content, onset=onset, duration=duration)
+            for _, content, onset, duration in words]))
+        for stim_id, words in groupby(rows, key=lambda r: r[0])
+    ]
 
-    return stims
+    stim_models = {
+        s.id: s for s in Stimulus.query.filter(
+            Stimulus.id.in_([stim_id for stim_id, _ in transcripts]))}
+    return [(stim_models[stim_id], cts) for stim_id, cts in transcripts]
 
 
-def _window_stim(cts, n):
-    """ Return windowed slices from a ComplexTextStim
+def _iter_windows(cts, n):
+    """ Lazily yield windowed slices from a ComplexTextStim
         Args:
             cts - _load_complex_text_stim_models
             n - size of window prior to current stimulus
         Output:
-            list of ComplexTextStim with n elements
+            generator of ComplexTextStim with n elements
+    """
+    elements = cts.elements
+    for ix_high in range(n, len(elements) + 1):
+        yield ComplexTextStim(elements=elements[ix_high - n:ix_high])
+
+
+def _batched(iterable, size):
+    """ Group an iterable into lists of (at most) size items """
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def _tokenized_graph(graph, cts_params):
+    """ Load a tokenized extraction Graph, with its window parameters """
+    g = Graph(nodes=graph)
+    window = cts_params.get("window", "transcript")
+    window_n = cts_params.get("n", 25) if window == "pre" else None
+
+    # Save window params as Graph attributes
+    for node in g.nodes.values():
+        setattr(node.transformer, "window_method", window)
+        if window_n:
+            setattr(node.transformer, "window_n", window_n)
+    return g
+
+
+def _tokenized_serializer(cts_params):
+    object_id = 'max' if cts_params.get("window") == 'pre' else None
+    return FeatureSerializer(
+        object_id=object_id, splat=True, add_all=False, round_n=4)
+
+
+def _extract_tokenized(cts, g, serializer, cts_params):
+    """ Apply a tokenized extraction Graph to a run transcript
+        Output:
+            list of serialized results
     """
-    ix_high = n
-    ix_low = 0
-    slices = []
-    while ix_high <= len(cts.elements):
-        subset_stim = ComplexTextStim(elements=cts.elements[ix_low:ix_high])
-        slices.append(subset_stim)
-        ix_high += 1
-        ix_low = ix_high - n
-    return slices
-
-
-def extract_tokenized_features(extractors, dataset_name=None, task_name=None):
+    # Slice stims if window type is "pre", and extract windows in
+    # batches (batch transformers process each batch in one call)
+    if cts_params.get("window") == "pre":
+        batches = _batched(
+            _iter_windows(cts, cts_params.get("n", 25)),
+            cts_params.get("batch_size", 64))
+    else:
+        batches = [cts]
+
+    return [
+        serializer.load(res)
+        for batch in batches for res in g.transform(batch, merge=False)
+    ]
+
+
+def _init_tokenized_worker(extractors, serializers):
+    """ Load tokenized extraction graphs once per worker process """
+    global _worker
+    _worker = SimpleNamespace(
+        graphs=[_tokenized_graph(g, p) for g, p in extractors],
+        params=[p for _, p in extractors], serializers=serializers)
+
+
+def _cts_payload(cts):
+    """ Words of a transcript, to send to workers """
+    return [(e.text, e.onset, e.duration) for e in cts.elements]
+
+
+def _extract_tokenized_in_worker(stim_id, words, graph_ix):
+    cts = ComplexTextStim(elements=[
+        TextStim(text=text, onset=onset, duration=duration)
+        for text, onset, duration in words])
+    return stim_id, _extract_tokenized(
+        cts, _worker.graphs[graph_ix], _worker.serializers[graph_ix],
+        _worker.params[graph_ix])
+
+
+def _iter_tokenized(stims, extractors, serializers, n_jobs=1):
+    """ Apply tokenized extraction graphs to transcripts, yielding results
+    as they are completed.
+        Yields:
+            tuples of Stimulus id and serialized results
+    """
+    if n_jobs == 1:
+        for (graph, cts_params), serializer in zip(extractors, serializers):
+            print("Graph: {}".format(graph))
+            g = _tokenized_graph(graph, cts_params)
+            for sm, cts in stims:
+                yield sm.id, _extract_tokenized(
+                    cts, g, serializer, cts_params)
+        return
+
+    if n_jobs < 0:
+        n_jobs = max(multiprocessing.cpu_count() + 1 + n_jobs, 1)
+
+    with multiprocessing.Pool(
+      n_jobs, initializer=_init_tokenized_worker,
+      initargs=(extractors, serializers)) as pool:
+        yield from _imap_bounded(
+            pool, _extract_tokenized_in_worker,
+            ((sm.id, _cts_payload(cts), ix)
+             for ix in range(len(extractors)) for sm, cts in stims),
+            4 * n_jobs)
+
+
+def extract_tokenized_features(extractors, dataset_name=None, task_name=None,
+                               n_jobs=1, batch_size=10000):
     """ Extract features that require a ComplexTextStim to give context to
-    individual words within a run """
+    individual words within a run
+        Args:
+            extractors - List of tuples of Graphs and window parameters
+            dataset_name - dataset name (optional;)
+            task_name - task name (optional)
+            n_jobs - Number of worker processes, over which
+                     (transcript, graph) pairs are distributed
+            batch_size - Number of ExtractedEvents to write at a time
+        Output:
+            list of db ids of created predictors
+    """
 
     if dataset_name is None:
-        return [extract_features(
-            extractors, dataset.name, None)
+        return [extract_tokenized_features(
+            extractors, dataset.name, None, n_jobs, batch_size)
                 for dataset in Dataset.query.filter_by(active=True)]
 
     stims = _load_complex_text_stim_models(dataset_name, task_name)
@@ -310,37 +990,26 @@ def extract_tokenized_features(extractors, dataset_name=None, task_name=None):
         print(f"Dataset {dataset_name} has no matching stimuli")
         return None
 
-    results = []
-    # For every extractor, extract from complex stims
-    for graph, cts_params in extractors:
-        print("Graph: {}".format(graph))
-        g = Graph(nodes=graph)
-        window = cts_params.get("window", "transcript")
-        window_n = cts_params.get("n", 25) if window == "pre" else None
-
-        object_id = 'max' if window == 'pre' else None
-        serializer = FeatureSerializer(
-            object_id=object_id, splat=True, add_all=False, round_n=4)
-
-        # Save window params as Graph attributes
-        for node in g.nodes.values():
-            setattr(node.transformer, "window_method", window)
-            if window_n:
-                setattr(node.transformer, "window_n", window_n)
-
-        for sm, s in tqdm(stims):
-            # Slice stims if window type is "pre"
-            w_stim = _window_stim(s, window_n) if window == "pre" else [s]
-
-            # Extract for every windowed slice
-            for sli in w_stim:
-                results += [
-                    (sm.id, serializer.load(res)) 
-                    for res in g.transform(sli, merge=False)
-                ]
-
-    # Serialize result objects first
-    ext_feats = _create_efs(results)
+    serializers = [_tokenized_serializer(p) for _, p in extractors]
+
+    # Write results in batches as they arrive
+    ext_feats = {}
+    batch, batch_events, n_events = [], 0, 0
+    with tqdm(desc="Extracting...", total=len(stims) * len(extractors),
+              unit="transcript") as progress:
+        for stim_id, results in _iter_tokenized(
+          stims, extractors, serializers, n_jobs):
+            batch += [(stim_id, res) for res in results]
+            n_new = sum(
+                len(ees['value']) for res in results for _, ees in res)
+            batch_events += n_new
+            n_events += n_new
+            progress.update()
+            progress.set_postfix(events=n_events)
+            if batch_events >= batch_size:
+                _create_efs(batch, ext_feats=ext_feats, progress=False)
+                batch, batch_events = [], 0
+        _create_efs(batch, ext_feats=ext_feats, progress=False)
 
     return create_predictors([ef for ef in ext_feats.values() if ef.active],
                              dataset_name, task_name)
@@ -8,48 +8,44 @@ from flask import current_app
 from pathlib import Path
 
 import pandas as pd
+from sqlalchemy import bindparam
 
 from bids.layout import BIDSLayout
 
 from ..core import cache
-from .utils import hash_stim
-from ..utils.db import get_or_create
+from .utils import (hash_stim, tqdm_joblib, probe_nifti_duration,
+                    load_file_cache, save_file_cache, get_cached, set_cached)
+from ..utils.db import (get_or_create, update_latest_predictors,
+                        bulk_insert, copy_insert)
 from ..models import (
     Dataset, Task, Run, Predictor, PredictorEvent, PredictorRun, Stimulus,
     RunStimulus, GroupPredictor, GroupPredictorValue)
 from ..database import db
 from tqdm import tqdm
+from joblib import Parallel, delayed, parallel_backend
 from .annotate import PredictorSerializer
 from datalad.api import drop, get
 
 
-def add_predictor_collection(collection, dataset_id, run_id,
-                             TR=None, include=None, exclude=None):
-    """ Add a RunNode to the database.
+def add_predictor_collection(collection, TR=None, include=None,
+                             exclude=None):
+    """ Annotate the variables of a RunNode collection for ingestion.
     Args:
         collection - BIDSVariableCollection to ingest
-        dataset_id - Dataset model id
-        run_id - Run model id
         TR - time repetiton of task
         include - list of predictors to include. all if None.
+        exclude - list of predictors to exclude.
+    Output:
+        list of tuples of Predictor properties and PredictorEvent arrays
     """
-    pe_objects = []
+    serializer = PredictorSerializer(
+        TR=TR, include=include, exclude=exclude)
+    annotated = []
     for var in collection.variables.values():
-        annotated = PredictorSerializer(
-            TR=TR, include=include, exclude=exclude).load(var)
-        if annotated is not None:
-            pred_props, pes_props = annotated
-            predictor, _ = get_or_create(
-                Predictor, dataset_id=dataset_id, **pred_props)
-            for pe in pes_props:
-                pe_objects.append(PredictorEvent(
-                               predictor_id=predictor.id, run_id=run_id, **pe))
-            # Add PredictorRun
-            pr, _ = get_or_create(
-                PredictorRun, predictor_id=predictor.id, run_id=run_id)
-
-    db.session.bulk_save_objects(pe_objects)
-    db.session.commit()
+        res = serializer.load(var)
+        if res is not None:
+            annotated.append(res)
+    return annotated
 
 
 def add_group_predictors(dataset_id, participants):
@@ -156,7 +152,8 @@ def add_dataset(dataset_name, dataset_summary, preproc_address, local_path,
 def add_task(task_name, dataset_name, local_path,
              include_predictors=None, exclude_predictors=None,
              reingest=False, scan_length=1000,
-             summary=None, layout=None, auto_fetch=False, **kwargs):
+             summary=None, layout=None, auto_fetch=False, n_jobs=1,
+             **kwargs):
     """ Adds a BIDS dataset task to the database.
         Args:
             task_name - task to add
@@ -168,6 +165,8 @@ def add_task(task_name, dataset_name, local_path,
             scan_length - default scan length in case it cant be found in image
             summary - Task summary description,
             layout - Preinstantiated BIDSLayout
+            auto_fetch - Automatically fetch and then drop nifti files
+            n_jobs - number of processes used to parse runs
             kwargs - arguments to filter runs by
         Output:
             dataset model id
@@ -213,86 +212,287 @@ def add_task(task_name, dataset_name, local_path,
         print("Task found, skipping ingestion...")
         return task_model.id
 
-    stims_processed = {}
+    # Image durations and stimulus hashes from previous ingestions
+    durations = load_file_cache('DURATION_CACHE')
+    hash_cache = load_file_cache('HASH_CACHE')
+
     """ Parse every Run """
-    print("Parsing runs")
-    for img in tqdm(all_runs):
-        if auto_fetch:
-            get(img.path)
-
-        """ Extract Run information """
-        # Get entities
-        entities = {entity: getattr(img, entity)
-                    for entity in ['subject', 'session', 'acquisition']
-                    if entity in img.entities}
-        run_number = img.run if hasattr(img, 'run') else None
-
-        run_model, new = get_or_create(
-            Run, dataset_id=dataset_model.id, number=run_number,
-            task_id=task_model.id, **entities)
-        entities['task'] = task_model.name
-        if run_number:
-            run_number = str(run_number).zfill(2)
-            entities['run'] = run_number
-
-        # Get duration (helps w/ transformations)
+    global _layout
+    _layout = layout
+    try:
+        with parallel_backend('multiprocessing'):
+            with tqdm_joblib(tqdm(desc="Parsing runs", total=len(all_runs))):
+                parsed = Parallel(n_jobs=n_jobs)(
+                    delayed(_parse_run)(
+                        img.path, task_model.name, task_model.TR, scan_length,
+                        include_predictors, exclude_predictors, auto_fetch,
+                        get_cached(durations, img.path))
+                    for img in all_runs)
+
+            """ Hash Stimuli """
+            stim_paths = {
+                val: local_path / 'stimuli' / val
+                for pr in parsed for val, _, _ in pr['stimuli']}
+            stim_hashes = {
+                val: get_cached(hash_cache, path)
+                for val, path in stim_paths.items()}
+            missing = [val for val, h in stim_hashes.items() if h is None]
+            with tqdm_joblib(tqdm(desc="Hashing stimuli",
+                                  total=len(missing))):
+                hashes = Parallel(n_jobs=n_jobs)(
+                    delayed(_hash_stim_file)(stim_paths[val])
+                    for val in missing)
+    finally:
+        _layout = None
+
+    probed = [pr for pr in parsed if pr.pop('probed')]
+    if probed:
+        for pr in probed:
+            set_cached(durations, pr['path'], pr['duration'])
+        save_file_cache('DURATION_CACHE', durations)
+
+    for val, stim_hash in zip(missing, hashes):
+        if stim_hash is None:
+            current_app.logger.debug(
+                '{} not found.'.format(stim_paths[val]))
+            del stim_hashes[val]
+        else:
+            stim_hashes[val] = stim_hash
+            set_cached(hash_cache, stim_paths[val], stim_hash)
+    if any(h is not None for h in hashes):
+        save_file_cache('HASH_CACHE', hash_cache)
+
+    """ Write all Runs to database """
+    print("Writing to database")
+    _write_runs(
+        parsed, stim_hashes, dataset_model.id, task_model.id, local_path)
+
+    return task_model.id
+
+
+# BIDSLayout shared with _parse_run. Set before workers are forked, so
+# the layout is inherited by each worker rather than pickled for each run.
+_layout = None
+
+
+def _parse_run(img_path, task_name, TR, scan_length=1000, include=None,
+               exclude=None, auto_fetch=False, duration=None):
+    """ Parse a single BIDS run: entities, duration, annotated predictors
+    and stimulus onsets. Does not touch the database, so it can run in
+    worker processes.
+    Args:
+        img_path - path to BOLD image of the run
+        task_name - task name
+        TR - time repetiton of task
+        scan_length - default scan length in case it cant be found in image
+        include - list of predictors to include. all if None.
+        exclude - list of predictors to exclude.
+        auto_fetch - Automatically fetch and then drop nifti file
+        duration - cached duration of the run. If None, it is read from
+                   the image header
+    Output:
+        dictionary of parsed run information
+    """
+    layout = _layout
+    img = layout.get_file(img_path)
+
+    """ Extract Run information """
+    # Get entities
+    entities = {entity: getattr(img, entity)
+                for entity in ['subject', 'session', 'acquisition']
+                if entity in img.entities}
+    run_number = img.run if hasattr(img, 'run') else None
+
+    parsed = {
+        'path': img.path,
+        'entities': entities.copy(),
+        'number': run_number,
+        'probed': False,
+    }
+
+    entities['task'] = task_name
+    if run_number:
+        entities['run'] = int(run_number)
+
+    # Get duration (helps w/ transformations)
+    if duration is None:
+        # Probe the header of the file if it is present, and only fetch
+        # the image if that fails
         try:
-            niimg = img.get_image()
-            run_model.duration = niimg.shape[3] * niimg.header.get_zooms()[-1]
-        except ValueError:
-            run_model.duration = scan_length
-
-        # Put back as int
-        if 'run' in entities:
-            entities['run'] = int(entities['run'])
-
-        """ Extract Predictors"""
-        # Assert event files exist (for DataLad)
-        for e in layout.get_nearest(
-          img.path, suffix='events', all_=True, strict=False):
-            assert isfile(e)
-
-        collection = layout.get_collections(
-            'run', scan_length=run_model.duration, desc=None,
-            **entities)[0]
-
-        if 'stim_file' in collection.variables:
-            stims = collection.variables.pop('stim_file')
+            duration = probe_nifti_duration(img.path)
+            parsed['probed'] = True
+        except (OSError, EOFError, ValueError):
+            if auto_fetch:
+                get(img.path)
+                try:
+                    duration = probe_nifti_duration(img.path)
+                    parsed['probed'] = True
+                except (OSError, EOFError, ValueError):
+                    pass
+                drop(img.path)
+        if duration is None:
+            duration = scan_length
+    parsed['duration'] = duration
+
+    """ Extract Predictors"""
+    # Assert event files exist (for DataLad)
+    for e in layout.get_nearest(
+      img.path, suffix='events', all_=True, strict=False):
+        assert isfile(e)
+
+    collection = layout.get_collections(
+        'run', scan_length=parsed['duration'], desc=None,
+        **entities)[0]
+
+    if 'stim_file' in collection.variables:
+        stims = collection.variables.pop('stim_file')
+        parsed['stimuli'] = list(zip(
+            stims.values, stims.onset.tolist(), stims.duration.tolist()))
+    else:
+        parsed['stimuli'] = []
+
+    parsed['predictors'] = add_predictor_collection(
+        collection, include=include, exclude=exclude, TR=TR)
+
+    return parsed
+
+
+def _hash_stim_file(stim_path):
+    """ Hash a stimulus file, or return None if it cannot be read """
+    try:
+        return hash_stim(stim_path)
+    except OSError:
+        return None
+
+
+def _write_runs(parsed, stim_hashes, dataset_id, task_id, local_path):
+    """ Write parsed runs to the database, with a handful of bulk statements
+    and a single commit.
+    Args:
+        parsed - list of parsed runs (see _parse_run)
+        stim_hashes - dictionary of stimulus file names to hashes
+        dataset_id - Dataset model id
+        task_id - Task model id
+        local_path - path to local bids dataset
+    """
+    """ Runs """
+    def _run_key(entities, number):
+        return tuple(entities.get(e) for e in
+                     ['subject', 'session', 'acquisition']) + (number, )
+
+    run_ids = {
+        _run_key({e: getattr(r, e) for e in [
+            'subject', 'session', 'acquisition']}, r.number): r.id
+        for r in Run.query.filter_by(dataset_id=dataset_id, task_id=task_id)
+    }
+
+    # Update durations of existing runs, insert new ones
+    new_runs, durations = {}, []
+    for pr in parsed:
+        key = _run_key(pr['entities'], pr['number'])
+        if key in run_ids:
+            durations.append(
+                {'_id': run_ids[key], 'duration': pr['duration']})
         else:
-            stims = None
-
-        add_predictor_collection(
-            collection, dataset_model.id, run_model.id,
-            include=include_predictors,
-            exclude=exclude_predictors, TR=task_model.TR)
-
-        """ Ingest Stimuli """
-        if stims is not None:
-            for i, val in enumerate(stims.values):
-                stim_path = local_path / 'stimuli' / val
-                if val not in stims_processed:
-                    try:
-                        stim_hash = hash_stim(stim_path)
-                    except OSError:
-                        current_app.logger.debug(
-                            '{} not found.'.format(stim_path))
-                        continue
-
-                    stims_processed[val] = stim_hash
-                else:
-                    stim_hash = stims_processed[val]
-                stim_model, _ = add_stimulus(
-                    stim_hash, path=stim_path, dataset_id=dataset_model.id)
-
-                # Get or create Run Stimulus association
-                runstim, _ = get_or_create(
-                    RunStimulus, stimulus_id=stim_model.id,
-                    run_id=run_model.id,
-                    onset=stims.onset.tolist()[i])
-                runstim.duration = stims.duration.tolist()[i]
-                db.session.commit()
-
-        if auto_fetch:
-            drop(img)
-
-    return task_model.id
\ No newline at end of file
+            new_runs[key] = dict(
+                dataset_id=dataset_id, task_id=task_id, number=pr['number'],
+                subject=key[0], session=key[1], acquisition=key[2],
+                duration=pr['duration'], active=True)
+
+    if durations:
+        run_table = Run.__table__
+        db.session.execute(
+            run_table.update().where(
+                run_table.c.id == bindparam('_id')).values(
+                    duration=bindparam('duration')), durations)
+
+    run_table = Run.__table__
+    for r in bulk_insert(run_table, list(new_runs.values()), returning=[
+      run_table.c.id, run_table.c.subject, run_table.c.session,
+      run_table.c.acquisition, run_table.c.number]):
+        run_ids[tuple(r[1:])] = r[0]
+
+    """ Predictors & PredictorEvents """
+    predictor_ids = {}
+    pe_chunks, pr_rows = [], set()
+    for pr in parsed:
+        run_id = run_ids[_run_key(pr['entities'], pr['number'])]
+        for pred_props, pes_props in pr['predictors']:
+            pred_key = tuple(sorted(pred_props.items()))
+            if pred_key not in predictor_ids:
+                predictor, _ = get_or_create(
+                    Predictor, commit=False, dataset_id=dataset_id,
+                    **pred_props)
+                db.session.flush()
+                predictor_ids[pred_key] = predictor.id
+            pred_id = predictor_ids[pred_key]
+
+            pe_chunks.append(
+                dict(predictor_id=pred_id, run_id=run_id, **pes_props))
+            pr_rows.add((pred_id, run_id))
+
+    copy_insert(PredictorEvent.__table__, pe_chunks)
+
+    bulk_insert(
+        PredictorRun.__table__,
+        [dict(predictor_id=p, run_id=r) for p, r in pr_rows],
+        index_elements=['run_id', 'predictor_id'])
+
+    """ Ingest Stimuli """
+    stim_paths = {
+        val: (local_path / 'stimuli' / val).resolve().as_posix()
+        for val in stim_hashes}
+    stim_query = Stimulus.query.filter_by(
+        dataset_id=dataset_id, parent_id=None, converter_name=None)
+    hash_ids = {
+        s.sha1_hash: s.id for s in stim_query.filter(
+            Stimulus.sha1_hash.in_(set(stim_hashes.values())))
+    }
+    # Stimuli hashed from decoded content (before hash_stim read raw file
+    # bytes) are matched by path instead
+    path_ids = {
+        s.path: s.id for s in stim_query.filter(Stimulus.path.in_([
+            stim_paths[val] for val, stim_hash in stim_hashes.items()
+            if stim_hash not in hash_ids]))
+    }
+
+    stim_ids, new_stims = {}, {}
+    for val, stim_hash in stim_hashes.items():
+        if stim_hash in hash_ids:
+            stim_ids[val] = hash_ids[stim_hash]
+        elif stim_paths[val] in path_ids:
+            stim_ids[val] = path_ids[stim_paths[val]]
+        elif stim_hash not in new_stims:
+            path = stim_paths[val]
+            new_stims[stim_hash] = dict(
+                sha1_hash=stim_hash, dataset_id=dataset_id, path=path,
+                mimetype=magic.from_file(path, mime=True), active=True)
+
+    stim_table = Stimulus.__table__
+    for stim_id, stim_hash in bulk_insert(
+      stim_table, list(new_stims.values()),
+      returning=[stim_table.c.id, stim_table.c.sha1_hash]):
+        hash_ids[stim_hash] = stim_id
+
+    for val, stim_hash in stim_hashes.items():
+        if val not in stim_ids:
+            stim_ids[val] = hash_ids[stim_hash]
+
+    # Create or update Run Stimulus associations
+    rs_rows = {}
+    for pr in parsed:
+        run_id = run_ids[_run_key(pr['entities'], pr['number'])]
+        for val, onset, duration in pr['stimuli']:
+            if val in stim_ids:
+                stim_id = stim_ids[val]
+                rs_rows[(stim_id, run_id, onset)] = dict(
+                    stimulus_id=stim_id, run_id=run_id, onset=onset,
+                    duration=duration)
+
+    bulk_insert(
+        RunStimulus.__table__, list(rs_rows.values()),
+        index_elements=['stimulus_id', 'run_id', 'onset'],
+        update=['duration'])
+
+    update_latest_predictors(set(predictor_ids.values()), commit=False)
+    db.session.commit()
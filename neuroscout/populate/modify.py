@@ -2,13 +2,14 @@
 Tools to modify/delete datasets already in database.
 """
 
-import json
-import re
 from flask import current_app
 from ..models import (Dataset, Task, Run, RunStimulus, Stimulus,
                       ExtractedFeature, ExtractedEvent, Predictor)
 from ..database import db
+from ..utils.db import materialize_pes, update_latest_predictors
 from .extract import create_predictors
+from .utils import compute_pred_stats
+from .annotate import load_schema, compile_pattern
 
 
 def delete_task(dataset, task):
@@ -69,6 +70,7 @@ def extend_extracted_objects(dataset_name, task_name, **selectors):
         ExtractedEvent).join(Stimulus).join(
             RunStimulus).filter(RunStimulus.run_id.in_(run_ids)).all()
 
+    # Also refreshes materialized PredictorEvents for these Runs
     create_predictors(efs, dataset_name, task_name, run_ids)
 
 
@@ -78,26 +80,27 @@ def update_annotations(mode='predictors', **kwargs):
         mode - Update 'predictors', 'features'
         kwargs - Additional filters on queries
     """
+    updated = []
     if mode == 'predictors':
-        schema = json.load(open(current_app.config['PREDICTOR_SCHEMA']))
+        schema, _ = load_schema(current_app.config['PREDICTOR_SCHEMA'])
         for pattern, atr in schema.items():
+            regex = compile_pattern(pattern)
             matching = Predictor.query.filter(
                 Predictor.original_name.op("~")(pattern)).filter_by(
                     ef_id=None, **kwargs)
 
             for match in matching:
-                match.name = re.sub(
-                    pattern, atr['name'], match.original_name) \
+                match.name = regex.sub(atr['name'], match.original_name) \
                     if 'name' in atr else match.name
-                match.description = re.sub(
-                    pattern, atr['description'], match.original_name) \
+                match.description = regex.sub(
+                    atr['description'], match.original_name) \
                     if 'description' in atr else None
                 if atr.get('source') is not None:
                     match.source = atr['source']
-            db.session.commit()
+                updated.append(match.id)
 
     elif mode == 'features':
-        schema = json.load(open(current_app.config['FEATURE_SCHEMA']))
+        schema, _ = load_schema(current_app.config['FEATURE_SCHEMA'])
         ext_name = kwargs.pop('extractor_name') \
             if 'extractor_name' in kwargs else None
         for extractor_name, args in schema.items():
@@ -109,16 +112,57 @@ def update_annotations(mode='predictors', **kwargs):
             # Warning, does not check against Extractor Parameters
             for version in args:
                 for pattern, atr in version['features'].items():
+                    regex = compile_pattern(pattern)
                     matching = candidate_efs.filter(
                         ExtractedFeature.original_name.op("~")(pattern))
                     for match in matching:
-                        match.feature_name = re.sub(
-                            pattern, atr['name'], match.original_name) \
+                        match.feature_name = regex.sub(
+                            atr['name'], match.original_name) \
                             if 'name' in atr else match.feature_name
-                        match.description = re.sub(
-                            pattern, atr['description'], match.original_name) \
+                        match.description = regex.sub(
+                            atr['description'], match.original_name) \
                             if 'description' in atr else None
                         for pred in match.generated_predictors:
                             pred.name = match.feature_name
                             pred.description = match.description
-                    db.session.commit()
+                            updated.append(pred.id)
+
+    # Renamed Predictors move to a new (task, name) in the cache table
+    db.session.flush()
+    if updated:
+        update_latest_predictors(updated, commit=False)
+    db.session.commit()
+
+
+def materialize_predictor_events(dataset_name):
+    """ Materialize PredictorEvents for all extracted Predictors in a
+    Dataset, so they are no longer computed on the fly.
+        Args:
+            dataset_name (str) - dataset name
+        Output:
+            list of materialized Predictor ids
+    """
+    dataset = Dataset.query.filter_by(name=dataset_name).one()
+    predictor_ids = [p.id for p in dataset.predictors.filter(
+        Predictor.ef_id.isnot(None))]
+
+    materialize_pes(predictor_ids)
+    return predictor_ids
+
+
+def recompute_predictor_stats(dataset_name, batch_size=1000):
+    """ Recompute summary statistics of all Predictors in a Dataset.
+        Args:
+            dataset_name (str) - dataset name
+            batch_size (int) - number of Predictors per aggregate query
+        Output:
+            list of Predictor ids
+    """
+    dataset = Dataset.query.filter_by(name=dataset_name).one()
+    predictor_ids = [p.id for p in dataset.predictors]
+
+    for ix in range(0, len(predictor_ids), batch_size):
+        compute_pred_stats(
+            db.session, predictor_ids[ix:ix + batch_size], commit=True)
+    return predictor_ids
+
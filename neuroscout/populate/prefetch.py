@@ -0,0 +1,88 @@
+""" Stimulus prefetching
+Fetch annexed stimulus files of datalad datasets in the background, ahead
+of extraction or conversion, and optionally drop them once used.
+"""
+import os
+import threading
+from datalad.api import drop, get
+
+
+def needs_fetch(path):
+    """ Whether path is an annexed file whose content is not present """
+    return os.path.islink(path) and not os.path.exists(path)
+
+
+class Prefetcher(object):
+    def __init__(self, items, ahead=8, drop_after=False):
+        """ Fetch files in a background thread, ahead of their use.
+        Every item must be released once it is no longer needed, which
+        frees its slot for the next file.
+        Args:
+            items - list of tuples of key and path, in order of use.
+                    Paths can be None (e.g. for text stimuli)
+            ahead - maximum number of items fetched and not yet released
+            drop_after - drop files that were fetched here, once released
+        """
+        self.ahead = ahead
+        self.drop_after = drop_after
+        self._slots = threading.Semaphore(ahead)
+        self._ready = {key: threading.Event() for key, _ in items}
+        self._fetched = {}
+        self._errors = {}
+        self._closed = False
+        self._thread = threading.Thread(
+            target=self._run, args=(list(items),), daemon=True)
+        self._thread.start()
+
+    def _run(self, items):
+        for key, path in items:
+            self._slots.acquire()
+            if self._closed:
+                return
+            try:
+                if path is not None and needs_fetch(path):
+                    get(path)
+                    self._fetched[key] = path
+            except Exception as e:
+                self._errors[key] = e
+            finally:
+                self._ready[key].set()
+
+    def wait(self, key):
+        """ Wait until the file of an item is present """
+        self._ready[key].wait()
+        if key in self._errors:
+            raise self._errors.pop(key)
+
+    def iter_ready(self, iterable, key):
+        """ Yield items of an iterable once their file is present
+        Args:
+            iterable - items, in the same order as the prefetched items
+            key - function returning the key of an item
+        """
+        for item in iterable:
+            self.wait(key(item))
+            yield item
+
+    def release(self, key):
+        """ Release an item, dropping its file if it was fetched here """
+        path = self._fetched.pop(key, None)
+        if path is not None and self.drop_after:
+            drop(path)
+        self._slots.release()
+
+    def close(self):
+        """ Stop prefetching, and drop files that were not released """
+        self._closed = True
+        self._slots.release()
+        self._thread.join()
+        if self.drop_after:
+            for path in self._fetched.values():
+                drop(path)
+        self._fetched = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,167 @@
+""" Remote API extraction
+Concurrency limits, rate limiting and retries for graphs that call remote
+APIs (e.g. Google, Clarifai), which are bound by API quotas rather than
+by local compute.
+"""
+import time
+import random
+import socket
+import threading
+import importlib
+from urllib.error import URLError
+
+# Connection errors and timeouts without an HTTP status
+TRANSIENT_ERRORS = (ConnectionError, TimeoutError, socket.timeout,
+                    socket.gaierror)
+try:
+    import requests
+    TRANSIENT_ERRORS += (requests.ConnectionError, requests.Timeout)
+except ImportError:
+    pass
+
+# HTTP statuses of failed calls that may succeed on retry
+TRANSIENT_STATUS = {408, 429, 500, 502, 503, 504}
+
+
+class TokenBucket(object):
+    def __init__(self, rate, capacity=None):
+        """ Thread-safe token bucket rate limiter.
+        Args:
+            rate - tokens added per second
+            capacity - maximum number of tokens (burst size). Defaults to
+                       one second of tokens
+        """
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self.tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """ Take a token, waiting until one is available """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity,
+                    self.tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def _status(error):
+    """ HTTP status of a failed call, for urllib, requests and provider
+    client (e.g. googleapiclient) errors """
+    for obj in (error, getattr(error, 'response', None),
+                getattr(error, 'resp', None)):
+        for attr in ('status_code', 'status', 'code'):
+            status = getattr(obj, attr, None)
+            if isinstance(status, int):
+                return status
+    return None
+
+
+def is_transient(error):
+    """ Whether a failed call may succeed on retry: rate limited and server
+    errors, and connection errors and timeouts """
+    status = _status(error)
+    if status is not None:
+        return status in TRANSIENT_STATUS
+    if isinstance(error, URLError):
+        # urllib wraps the underlying error
+        return isinstance(error.reason, BaseException) and \
+            is_transient(error.reason)
+    return isinstance(error, TRANSIENT_ERRORS)
+
+
+def _import_class(name):
+    module, name = name.rsplit('.', 1)
+    return getattr(importlib.import_module(module), name)
+
+
+class RemoteLimiter(object):
+    def __init__(self, providers=None, max_retries=5, backoff=1,
+                 max_backoff=60, retry_on=()):
+        """ Limit calls to remote APIs, per provider.
+        Args:
+            providers - dictionary of provider names to limits: maximum
+                        number of concurrent calls ("concurrency"), calls per
+                        second ("rate") and burst size ("burst"). Limits of
+                        the "default" entry apply to other providers
+            max_retries - number of retries of failed calls
+            backoff - delay before the first retry, in seconds. Doubled on
+                      each retry...
+            max_backoff - ...up to this delay
+            retry_on - exceptions to retry, in addition to transient errors
+                       (see is_transient). Classes, or dotted class names
+        """
+        self.providers = providers or {}
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.retry_on = tuple(
+            _import_class(e) if isinstance(e, str) else e for e in retry_on)
+        self._limits = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        """ Limiter from a REMOTE_EXTRACTORS config dictionary """
+        config = dict(config)
+        providers = config.pop('providers', {})
+        return cls(providers, **config)
+
+    def _get_limits(self, provider):
+        with self._lock:
+            if provider not in self._limits:
+                limits = self.providers.get(
+                    provider, self.providers.get('default', {}))
+                concurrency = limits.get('concurrency')
+                rate = limits.get('rate')
+                self._limits[provider] = (
+                    threading.BoundedSemaphore(concurrency)
+                    if concurrency else None,
+                    TokenBucket(rate, limits.get('burst'))
+                    if rate else None)
+            return self._limits[provider]
+
+    def call(self, provider, func, *args, **kwargs):
+        """ Call a function that uses a provider's API, within the provider's
+        limits, retrying failed calls with exponential backoff. Calls
+        without a provider (local extraction) are neither limited nor
+        retried """
+        if provider is None:
+            return func(*args, **kwargs)
+        semaphore, bucket = self._get_limits(provider)
+        for attempt in range(self.max_retries + 1):
+            if semaphore is not None:
+                semaphore.acquire()
+            try:
+                if bucket is not None:
+                    bucket.acquire()
+                return func(*args, **kwargs)
+            except Exception as e:
+                if attempt == self.max_retries or not (
+                        is_transient(e) or isinstance(e, self.retry_on)):
+                    raise
+            finally:
+                if semaphore is not None:
+                    semaphore.release()
+
+            # Back off (with jitter), without holding a concurrency slot
+            delay = min(self.backoff * 2 ** attempt, self.max_backoff)
+            time.sleep(delay * random.uniform(0.5, 1))
+
+
+def graph_provider(graph):
+    """ Name of the remote API provider used by a pliers Graph, or None if
+    the graph does not call remote APIs """
+    for node in graph.nodes.values():
+        module = type(node.transformer).__module__
+        if '.api.' in module:
+            return module.rsplit('.', 1)[-1]
+    return None
@@ -166,12 +166,15 @@ def convert_config(config_file):
         json.dump(new_dict, f, indent=4)
 
 
-def ingest_from_json(config_file, reingest=False, auto_fetch=False):
+def ingest_from_json(config_file, reingest=False, auto_fetch=False,
+                     n_jobs=None):
     """ Adds a dataset from a JSON configuration file
         Args:
             config_file - a path to a json file
             reingest - force reingest tasks
             auto_fetch - Automatically fetch and then drop nifti files
+            n_jobs - number of processes used to parse runs. If None, taken
+                     from the config file (default: 1)
         Output:
             list of dataset model ids
     """
@@ -181,6 +184,8 @@ def ingest_from_json(config_file, reingest=False, auto_fetch=False):
 
     dataset_name = config['name']
     local_path = config['path']        
+    if n_jobs is None:
+        n_jobs = config.get('n_jobs', 1)
 
     # Add dataset
     dataset_id = add_dataset(
@@ -200,6 +205,7 @@ def ingest_from_json(config_file, reingest=False, auto_fetch=False):
     task_ids = []
     for task_name, params in config['tasks'].items():
         """ Add task to database"""
+        params = {'n_jobs': n_jobs, **params}
         task_id = add_task(
             task_name,
             dataset_name,
@@ -216,7 +222,8 @@ def ingest_from_json(config_file, reingest=False, auto_fetch=False):
     return dataset_id
 
 
-def extract_from_json(extract_config, dataset_name=None, task_name=None):
+def extract_from_json(extract_config, dataset_name=None, task_name=None,
+                      incremental=False, n_jobs=None):
     """ Applies JSON file specifying conversion and extractions to
     specifed tasks.
 
@@ -225,6 +232,14 @@ def extract_from_json(extract_config, dataset_name=None, task_name=None):
           See: config/transformers.json for full example
         dataset_name: dataset name. If none, applied to all datasets / tasks
         task_name: If dataset_name is specified, can apply to specific task
+        incremental: Only extract features for stimuli that have not yet
+          been extracted with the same extractor
+        n_jobs: number of extraction processes. If None, taken from the
+          config's "n_jobs" (default 1)
+
+    The config's "prefetch" (number of stimuli) and "drop_after" settings
+    fetch annexed stimuli in the background during conversion and
+    extraction, and drop them once used.
     """
 
     if dataset_name is None and task_name is not None:
@@ -234,17 +249,27 @@ def extract_from_json(extract_config, dataset_name=None, task_name=None):
     with open(extract_config, 'r') as f:
         config = json.load(f)
 
+    if n_jobs is None:
+        n_jobs = config.get('n_jobs', 1)
+
+    # Fetch annexed stimuli in the background, and optionally drop them
+    prefetch = config.get('prefetch')
+    drop_after = config.get('drop_after', False)
+
     """ Convert stimuli """
     converters = config.get('converters', None)
     if converters:
         print("Converting... {}".format(converters))
-        convert_stimuli(converters, dataset_name, task_name)
+        convert_stimuli(converters, dataset_name, task_name,
+                        prefetch=prefetch, drop_after=drop_after)
 
     """ Extract features from applicable stimuli """
     extractor_graphs = config.get('extractors', None)
     if extractor_graphs:
         print("Extracting...")
-        extract_features(extractor_graphs, dataset_name, task_name)
+        extract_features(extractor_graphs, dataset_name, task_name,
+                         n_jobs=n_jobs, incremental=incremental,
+                         prefetch=prefetch, drop_after=drop_after)
 
     """ Extract features that require pre-tokenization """
     tokenized_extractors = config.get('tokenized_extractors', None)
@@ -252,7 +277,7 @@ def extract_from_json(extract_config, dataset_name=None, task_name=None):
         print("Tokenizing and extracting... {}".format(
             tokenized_extractors))
         extract_tokenized_features(
-            tokenized_extractors, dataset_name, task_name)
+            tokenized_extractors, dataset_name, task_name, n_jobs=n_jobs)
 
     """ Apply transformations """
     transformations = config.get("transformations", [])
@@ -6,8 +6,8 @@ from flask import current_app
 from sqlalchemy import func
 from .utils import hash_data
 from .extract import create_predictors
+from .annotate import load_schema
 import pandas as pd
-import json
 
 
 class Postprocessing(object):
@@ -72,7 +72,7 @@ class Postprocessing(object):
     def _get_annotations(feature_name, ext_name):
         """ Gets annotations from feature schema """
         kwargs = {}
-        schema = json.load(open(current_app.config['FEATURE_SCHEMA']))
+        schema, _ = load_schema(current_app.config['FEATURE_SCHEMA'])
         for version in schema.get(ext_name, []):
             for name, attr in version['features'].items():
                 if name == feature_name:
@@ -1,13 +1,21 @@
 """ Populaton utilities
 """
 from flask import current_app
+import os
 import json
+import gzip
+import pickle
 import hashlib
+from io import BytesIO
 from pathlib import Path
 import contextlib
 import joblib
-import numpy as np
+from nibabel import Nifti1Header, Nifti2Header
+from nibabel.spatialimages import HeaderDataError
 from citeproc.source.json import CiteProcJSON
+from sqlalchemy import (select, union_all, case, cast, func, bindparam,
+                        Float)
+from ..models import Predictor, PredictorEvent, ExtractedEvent
 
 
 def add_to_bibliography(entry_name, bib_entries, sub_match='.*'):
@@ -32,29 +40,27 @@ def add_to_bibliography(entry_name, bib_entries, sub_match='.*'):
     return True
 
 
-def hash_stim(stim, blocksize=65536):
-    """ Hash a pliers stimulus """
+def hash_stim(stim, blocksize=1 << 20):
+    """ Hash a pliers stimulus, or the raw bytes of a stimulus file.
+    Files are streamed without being loaded (or decoded) by pliers """
     if isinstance(stim, Path):
         stim = stim.as_posix()
-    if isinstance(stim, str):
-        from pliers.stimuli import load_stims
-        from os.path import isfile
-        assert isfile(stim)
-        stim = load_stims(stim)
-
-    hasher = hashlib.sha1()
 
-    if hasattr(stim, "data"):
+    if isinstance(stim, str):
+        filename = stim
+    elif hasattr(stim, "data"):
         return hash_data(stim.data)
     else:
         filename = stim.history.source_file \
                     if stim.history \
                     else stim.filename
-        with open(filename, 'rb') as afile:
+
+    hasher = hashlib.sha1()
+    with open(filename, 'rb') as afile:
+        buf = afile.read(blocksize)
+        while len(buf) > 0:
+            hasher.update(buf)
             buf = afile.read(blocksize)
-            while len(buf) > 0:
-                hasher.update(buf)
-                buf = afile.read(blocksize)
 
     return hasher.hexdigest()
 
@@ -71,6 +77,178 @@ def hash_data(data):
     return hasher.hexdigest()
 
 
+def annex_key(path):
+    """ Git-annex key of a file, read from its symlink (no content needed).
+    Returns None if the file is not annexed """
+    try:
+        target = os.readlink(path)
+    except OSError:
+        return None
+    if '.git/annex/objects' not in target:
+        return None
+    return os.path.basename(target)
+
+
+def probe_nifti_duration(path):
+    """ Compute the duration of a 4D NIfTI image from its header alone.
+    For gzipped images, only the first compressed block is decompressed.
+    """
+    path = str(path)
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rb') as f:
+        data = f.read(540)
+
+    # sizeof_hdr distinguishes NIfTI-1 (348) from NIfTI-2 (540) headers
+    sizeof_hdr = int.from_bytes(data[:4], 'little')
+    if sizeof_hdr not in (348, 540):
+        sizeof_hdr = int.from_bytes(data[:4], 'big')
+    try:
+        if sizeof_hdr == 348:
+            header = Nifti1Header.from_fileobj(BytesIO(data[:348]))
+        elif sizeof_hdr == 540:
+            header = Nifti2Header.from_fileobj(BytesIO(data))
+        else:
+            raise ValueError("{} is not a NIfTI image".format(path))
+    except HeaderDataError as e:
+        raise ValueError(str(e))
+
+    shape = header.get_data_shape()
+    if len(shape) < 4:
+        raise ValueError("{} is not a 4D image".format(path))
+    return float(shape[3] * header.get_zooms()[3])
+
+
+def file_key(path):
+    """ Key identifying the content of a file, for persistent caches.
+    Annexed files are keyed by annex key, others by path, size, mtime and
+    inode. Returns None if the file does not exist """
+    key = annex_key(path)
+    if key is not None:
+        return 'annex:' + key
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return 'path:{}:{}:{}:{}'.format(
+        os.path.abspath(path), stat.st_size, stat.st_mtime, stat.st_ino)
+
+
+def load_file_cache(name):
+    """ Load a persistent cache of file properties.
+    Args:
+        name - app config variable with the path to the cache
+    """
+    try:
+        with open(current_app.config[name], 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_file_cache(name, cache):
+    """ Save a persistent cache of file properties """
+    path = Path(current_app.config[name])
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix('.tmp')
+    with tmp_path.open('w') as f:
+        json.dump(cache, f)
+    os.replace(str(tmp_path), str(path))
+
+
+def get_cached(cache, path):
+    """ Look up the cached value for a file, or None """
+    key = file_key(path)
+    return cache.get(key) if key is not None else None
+
+
+def set_cached(cache, path, value):
+    """ Store the cached value for a file """
+    key = file_key(path)
+    if key is not None:
+        cache[key] = value
+
+
+def _graph_spec(nodes):
+    """ Transformer names, parameters and versions of graph nodes """
+    spec = []
+    for node in nodes:
+        transformer = node.transformer
+        spec.append({
+            'transformer': transformer.__class__.__name__,
+            'version': getattr(transformer, 'VERSION', None),
+            'parameters': {
+                attr: getattr(transformer, attr, None)
+                for attr in getattr(transformer, '_log_attributes', ())},
+            'children': _graph_spec(node.children)
+        })
+    return spec
+
+
+def extraction_cache_key(stim_hash, graph, serializer):
+    """ Key of a serialized extraction result in the extraction cache.
+    Args:
+        stim_hash - Stimulus sha1_hash
+        graph - pliers Graph applied to the stimulus
+        serializer - FeatureSerializer used to serialize results
+    """
+    serializer_spec = {
+        k: v for k, v in vars(serializer).items() if k != 'schema'}
+    serializer_spec['version'] = getattr(serializer, 'VERSION', None)
+    return hash_data(json.dumps(
+        [stim_hash, _graph_spec(graph.roots), serializer_spec],
+        sort_keys=True, default=str))
+
+
+def load_cached_result(cache_dir, key):
+    """ Load a cached extraction result, or None if not cached """
+    path = Path(cache_dir) / key[:2] / key
+    try:
+        with path.open('rb') as f:
+            result = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+    # Mark as recently used
+    os.utime(str(path))
+    return result
+
+
+def cached_result_exists(cache_dir, key):
+    """ Whether an extraction result is cached """
+    return (Path(cache_dir) / key[:2] / key).exists()
+
+
+def save_cached_result(cache_dir, key, result):
+    """ Save an extraction result to the extraction cache """
+    path = Path(cache_dir) / key[:2] / key
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix('.{}.tmp'.format(os.getpid()))
+    with tmp_path.open('wb') as f:
+        pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(str(tmp_path), str(path))
+
+
+def prune_cache(cache_dir, max_size):
+    """ Evict least recently used entries until the cache directory is
+    no larger than max_size bytes """
+    entries = []
+    for path in Path(cache_dir).glob('*/*'):
+        try:
+            stat = path.stat()
+        except OSError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        try:
+            path.unlink()
+        except OSError:
+            continue
+        total -= size
+
+
 @contextlib.contextmanager
 def tqdm_joblib(tqdm_object):
     """Context manager to patch joblib to report into tqdm progress
@@ -91,41 +269,65 @@ def tqdm_joblib(tqdm_object):
         tqdm_object.close()
         
         
-def compute_pred_stats(session, pred, commit=False):
+# Values that can be safely cast to a float. Digits and exponents are
+# bounded, so that matching values are within double precision range
+NUMERIC_PATTERN = (r'^\s*([-+]?(\d{1,200}(\.\d{0,200})?|\.\d{1,200})'
+                   r'([eE][-+]?\d{1,2})?|[-+]?(inf|infinity)|nan)\s*$')
+
+
+def compute_pred_stats(session, predictor_ids, commit=False):
     """ Computes hard coded pre-computed metrics upon ingestion (or on demand)
-    for a Predictor """
-    def get_max(vals):
-        if vals:
-            vals =  max(vals)
-        return vals
-
-    def get_min(vals):
-        if vals:
-            vals =  min(vals)
-        return vals
-    
-    def remove_nas(vals):
-        return [v for v in vals if v == 'n/a']
-
-    def num_na(vals):
-        if vals:
-            vals = len(remove_nas(vals))
-        return vals
-    
-    def mean(vals):
-        if vals:
-            vals = np.mean(vals)
-        return vals
-    
-    values = pred.float_values
-    
-    pred.max = get_max(values)
-    pred.min = get_min(values)
-    pred.num_na = num_na(values)
-    pred.mean = mean(values)
-        
+    for Predictors, in a single aggregate query.
+    Metrics are only set for numeric Predictors (all values are numbers or
+    'n/a'). 'n/a' values are counted, and ignored in other metrics.
+    Args:
+        session - database session
+        predictor_ids - list of Predictor ids
+        commit - commit session
+    """
+    predictor_ids = list(predictor_ids)
+    if not predictor_ids:
+        return
+
+    # Values of extracted Predictors come from their ExtractedFeature
+    pred = Predictor.__table__
+    ee = ExtractedEvent.__table__
+    pe = PredictorEvent.__table__
+    values = union_all(
+        select([pred.c.id.label('predictor_id'), ee.c.value]).select_from(
+            pred.join(ee, ee.c.ef_id == pred.c.ef_id)).where(
+                pred.c.id.in_(predictor_ids)),
+        select([pred.c.id.label('predictor_id'), pe.c.value]).select_from(
+            pred.join(pe, pe.c.predictor_id == pred.c.id)).where(
+                pred.c.id.in_(predictor_ids) & pred.c.ef_id.is_(None))
+    ).alias('pred_values')
+
+    is_numeric = values.c.value.op('~*')(NUMERIC_PATTERN)
+    is_na = values.c.value == 'n/a'
+    numeric = case([(is_numeric, cast(values.c.value, Float))])
+    stats = select([
+        values.c.predictor_id,
+        func.count().label('n'),
+        func.count(numeric).label('n_numeric'),
+        func.count(case([(is_na, 1)])).label('n_na'),
+        func.max(numeric).label('max'),
+        func.min(numeric).label('min'),
+        func.avg(numeric).label('mean'),
+    ]).group_by(values.c.predictor_id)
+
+    metrics = {
+        pred_id: dict(_id=pred_id, max=None, min=None, mean=None, num_na=None)
+        for pred_id in predictor_ids}
+    for row in session.execute(stats):
+        if row.n_numeric and row.n_numeric + row.n_na == row.n:
+            metrics[row.predictor_id].update(
+                max=row.max, min=row.min, mean=row.mean, num_na=row.n_na)
+
+    session.execute(
+        pred.update().where(pred.c.id == bindparam('_id')).values(
+            max=bindparam('max'), min=bindparam('min'),
+            mean=bindparam('mean'), num_na=bindparam('num_na')),
+        list(metrics.values()))
+
     if commit:
-        session.add(pred)
         session.commit()
-        
-    return pred
\ No newline at end of file
@@ -1,12 +1,13 @@
-from flask import send_file, current_app
+from flask import send_file, current_app, Response, stream_with_context
 from flask_apispec import MethodResource, marshal_with, use_kwargs, doc
 from flask_jwt import current_identity
-from ...models import Analysis, Report, Predictor
+from ...models import Analysis, Report, Predictor, Run, analysis_run
 from ...database import db
 from ...core import cache
 from os.path import exists
 import datetime
 from webargs import fields
+from sqlalchemy.orm import joinedload
 import json
 import requests
 
@@ -17,6 +18,7 @@ from ..predictor import get_predictors
 from ...schemas.analysis import (
     AnalysisSchema, AnalysisFullSchema,
     AnalysisResourcesSchema, BibliographySchema)
+from ...schemas.run import RunSchema
 
 @doc(tags=['analysis'])
 @marshal_with(AnalysisSchema)
@@ -177,11 +179,54 @@ class CloneAnalysisResource(AnalysisMethodResource):
         return cloned, 200
 
 
+# Stands in for the runs array when encoding the rest of the analysis
+_RUNS_PLACEHOLDER = '__streamed_runs__'
+
+
+def _stream_full_analysis(analysis, chunk_size=500):
+    """ Serialize analysis with nested fields, streaming the (potentially
+    very long) list of nested runs as a chunked JSON array """
+    full = AnalysisFullSchema(exclude=['runs']).dump(analysis)
+    if 'runs' in full or _RUNS_PLACEHOLDER in json.dumps(full):
+        raise ValueError("Cannot stream analysis: unexpected runs field")
+    full['runs'] = _RUNS_PLACEHOLDER
+
+    # Encode everything but the runs, and split where they go
+    head, tail = json.dumps(full).split(json.dumps(_RUNS_PLACEHOLDER))
+    yield head + '['
+
+    runs = Run.query.join(analysis_run).filter(
+        analysis_run.c.analysis_id == analysis.id).options(
+            joinedload(Run.task)).order_by(Run.id).yield_per(chunk_size)
+    schema = RunSchema(exclude=('dataset_id', 'task'))
+
+    chunk, sep = [], ''
+    for run in runs:
+        chunk.append(run)
+        if len(chunk) == chunk_size:
+            yield sep + json.dumps(schema.dump(chunk, many=True))[1:-1]
+            chunk, sep = [], ', '
+    if chunk:
+        yield sep + json.dumps(schema.dump(chunk, many=True))[1:-1]
+
+    yield ']' + tail
+
+
 class AnalysisFullResource(AnalysisMethodResource):
     @marshal_with(AnalysisFullSchema)
     @doc(summary='Get analysis (including nested fields).')
+    @use_kwargs({
+        'stream': fields.Boolean(
+            missing=False,
+            description="Stream response as a chunked JSON object, "
+                        "to bound memory use for analyses with many runs.")
+        }, location='query')
     @fetch_analysis
-    def get(self, analysis):
+    def get(self, analysis, stream=False):
+        if stream:
+            return Response(
+                stream_with_context(_stream_full_analysis(analysis)),
+                mimetype='application/json')
         return analysis, 200
 
 
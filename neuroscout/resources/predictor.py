@@ -1,15 +1,17 @@
 from webargs import fields
 import tempfile
 import json
+import gzip
+import pandas as pd
 from marshmallow import INCLUDE, Schema
-from sqlalchemy import func, or_
+from sqlalchemy import or_
 from flask_apispec import MethodResource, marshal_with, use_kwargs, doc
 from flask_jwt import current_identity
-from flask import current_app
+from flask import current_app, request, Response, stream_with_context
 from pathlib import Path
 from .utils import abort, auth_required, first_or_404
 from ..models import (
-    Analysis, Dataset,
+    Analysis, Dataset, LatestPredictor,
     Predictor, PredictorRun, PredictorCollection, Task)
 from ..database import db
 from ..core import cache
@@ -17,7 +19,7 @@ from ..schemas.predictor import (
     PredictorSchema, PredictorEventSchema, PredictorCollectionSchema, PredictorRelatedSchema)
 from ..api_spec import FileField
 from ..worker import celery_app
-from ..utils.db import dump_predictor_events
+from ..utils.db import dump_predictor_events, iter_predictor_events
 
 
 class PredictorResource(MethodResource):
@@ -27,18 +29,19 @@ class PredictorResource(MethodResource):
         return first_or_404(Predictor.query.filter_by(id=predictor_id))
 
 
-def get_predictors(newest=True, active=True, user=None, **kwargs):
-    """ Helper function for querying newest predictors """
+def predictors_query(newest=True, active=True, user=None, **kwargs):
+    """ Build query for (newest) predictors """
     if newest:
-        predictor_ids = db.session.query(
-            func.max(Predictor.id)).group_by(Predictor.name)
+        predictor_ids = db.session.query(LatestPredictor.predictor_id)
+        id_column = LatestPredictor.predictor_id
     else:
         predictor_ids = db.session.query(Predictor.id)
+        id_column = Predictor.id
 
     if 'run_id' in kwargs:
-        # This following JOIN can be slow
-        predictor_ids = predictor_ids.join(PredictorRun).filter(
-            PredictorRun.run_id.in_(kwargs.pop('run_id')))
+        predictor_ids = predictor_ids.join(
+            PredictorRun, PredictorRun.predictor_id == id_column).filter(
+                PredictorRun.run_id.in_(kwargs.pop('run_id')))
 
     query = Predictor.query.filter(Predictor.id.in_(predictor_ids))
 
@@ -54,15 +57,20 @@ def get_predictors(newest=True, active=True, user=None, **kwargs):
     else:
         query = query.filter_by(private=False)
 
-    # Only display active predictors
-    return query.all()
+    return query
+
+
+def get_predictors(newest=True, active=True, user=None, **kwargs):
+    """ Helper function for querying newest predictors """
+    return predictors_query(
+        newest=newest, active=active, user=user, **kwargs).all()
 
 
 class PredictorListResource(MethodResource):
     @doc(tags=['predictors'], summary='Get list of predictors.',)
     @use_kwargs({
         'run_id': fields.DelimitedList(
-            fields.Int(), description="Run id(s). Warning, slow query."),
+            fields.Int(), description="Run id(s)"),
         'name': fields.DelimitedList(
             fields.Str(), description="Predictor name(s)"),
         'active_only': fields.Boolean(
@@ -70,7 +78,7 @@ class PredictorListResource(MethodResource):
             description="Return only active Predictors"),
         'newest': fields.Boolean(
             missing=True,
-            description="Return only newest Predictor by name")
+            description="Return only newest Predictor by name, per task")
         },
         location='query')
     @cache.cached(60 * 60 * 24 * 300, query_string=True)
@@ -120,7 +128,7 @@ class TaskPredictorsResource(MethodResource):
             description="Return only active Predictors"),
         'newest': fields.Boolean(
             missing=True,
-            description="Return only newest Predictor by name")
+            description="Return only newest Predictor by name, per task")
         },
         location='query')
     @cache.cached(60 * 60 * 24 * 300, query_string=True)
@@ -198,8 +206,64 @@ class PredictorCollectionResource(MethodResource):
             PredictorCollection.query.filter_by(id=pc_id))
 
 
+PE_FORMATS = {
+    'json': 'application/json',
+    'tsv': 'text/tab-separated-values',
+    'arrow': 'application/vnd.apache.arrow.stream',
+    'parquet': 'application/vnd.apache.parquet',
+    'ndjson': 'application/x-ndjson'
+}
+
+
+def _negotiate_format(format=None):
+    """ Determine response format from format argument or Accept header """
+    if format is None:
+        best = request.accept_mimetypes.best_match(
+            list(PE_FORMATS.values()), default=PE_FORMATS['json'])
+        format = {v: k for k, v in PE_FORMATS.items()}[best]
+    return format
+
+
+def _columnar_response(pes, format):
+    """ Serialize columnar PredictorEvents, with no per-row schema dump """
+    headers = {}
+    if format == 'tsv':
+        data = pd.DataFrame(pes).to_csv(
+            sep='\t', index=False).encode('utf-8')
+        headers['Vary'] = 'Accept-Encoding'
+        # Only compress for clients that accept it
+        if request.accept_encodings['gzip']:
+            data = gzip.compress(data)
+            headers['Content-Encoding'] = 'gzip'
+    else:
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            abort(406, f"Format '{format}' is not available on this server.")
+
+        table = pa.Table.from_pydict(pes)
+        sink = pa.BufferOutputStream()
+        if format == 'arrow':
+            writer = pa.ipc.new_stream(sink, table.schema)
+            writer.write_table(table)
+            writer.close()
+        else:
+            pq.write_table(table, sink)
+        data = sink.getvalue().to_pybytes()
+
+    return Response(data, mimetype=PE_FORMATS[format], headers=headers)
+
+
+def _ndjson_stream(chunks):
+    """ Encode chunks of PredictorEvents as newline delimited JSON """
+    for chunk in chunks:
+        yield ''.join(json.dumps(pe) + '\n' for pe in chunk)
+
+
 class PredictorEventListResource(MethodResource):
-    @doc(tags=['predictors'], summary='Get events for predictor(s)',)
+    @doc(tags=['predictors'], summary='Get events for predictor(s)',
+         produces=list(PE_FORMATS.values()))
     @marshal_with(PredictorEventSchema(many=True))
     @use_kwargs({
         'run_id': fields.DelimitedList(
@@ -211,12 +275,33 @@ class PredictorEventListResource(MethodResource):
             required=True),
         'stimulus_timing': fields.Boolean(
             missing=False,
-            description="Return stimulus timing and information")
+            description="Return stimulus timing and information"),
+        'format': fields.Str(
+            validate=lambda f: f in PE_FORMATS,
+            description="Response format, one of: json, tsv (gzipped, "
+                        "if accepted), "
+                        "arrow (IPC stream), parquet, ndjson (streamed). "
+                        "If not set, determined by the Accept header.")
         }, location='query')
-    @cache.cached(60 * 60 * 24 * 300, query_string=True)
-    def get(self, predictor_id, run_id=None, stimulus_timing=False):
-        return dump_predictor_events(
-            predictor_id, run_id, stimulus_timing=stimulus_timing)
+    @cache.cached(60 * 60 * 24 * 300, query_string=True,
+                  unless=lambda: _negotiate_format(
+                      request.args.get('format')) != 'json')
+    def get(self, predictor_id, run_id=None, stimulus_timing=False,
+            format=None):
+        format = _negotiate_format(format)
+        if format == 'ndjson':
+            chunks = iter_predictor_events(
+                predictor_id, run_id, stimulus_timing=stimulus_timing)
+            return Response(
+                stream_with_context(_ndjson_stream(chunks)),
+                mimetype=PE_FORMATS[format])
+
+        pes = dump_predictor_events(
+            predictor_id, run_id, stimulus_timing=stimulus_timing,
+            columnar=(format != 'json'))
+        if format != 'json':
+            return _columnar_response(pes, format)
+        return pes
 
 ''' Get the ExtractedFeature for the predictor, get all ExtractedFeatures
     with same feature_name and extractor, get all dataset_ids from Predictor
@@ -0,0 +1,44 @@
+""" Distributed feature extraction
+Units of work dispatched by populate.extract.dispatch_extraction
+"""
+from pliers.graph import Graph
+
+from ..models import Stimulus, ExtractedFeature
+from ..populate.annotate import FeatureSerializer
+from ..populate.extract import (_extract_to_serial, write_extraction_unit,
+                                create_predictors as _create_predictors)
+
+
+def extract_unit(flask_app, stimulus_id, graph, extraction_id, use_cache=True,
+                 serializer_kwargs=None):
+    """ Apply a graph to a stimulus, and write the results.
+    Args:
+        stimulus_id (int): Stimulus id
+        graph (list): pliers Graph spec
+        extraction_id (str): id of the dispatched extraction
+        use_cache (bool): Read and save results in the extraction cache
+        serializer_kwargs (dict): Arguments to pass to FeatureSerializer
+    Returns:
+        list of ExtractedFeature ids
+    """
+    stim = Stimulus.query.filter_by(id=stimulus_id).one()
+    serializer = FeatureSerializer(**(serializer_kwargs or {}))
+    cache_dir = flask_app.config['EXTRACTION_CACHE'] if use_cache else None
+
+    results = _extract_to_serial([Graph(graph)], stim, serializer, cache_dir)
+    return write_extraction_unit(stim.id, results, extraction_id)
+
+
+def create_predictors(flask_app, ef_ids, dataset_name, task_name=None):
+    """ Create Predictors once all units of an extraction have finished.
+    Args:
+        ef_ids (list): lists of ExtractedFeature ids, one per unit
+        dataset_name (str): Dataset name
+        task_name (str): Task name
+    Returns:
+        list of Predictor ids
+    """
+    ef_ids = set(i for unit in ef_ids for i in unit)
+    features = ExtractedFeature.query.filter(
+        ExtractedFeature.id.in_(ef_ids), ExtractedFeature.active.is_(True))
+    return _create_predictors(features.all(), dataset_name, task_name)
@@ -3,7 +3,7 @@ from pynv import Client
 import re
 from pathlib import Path
 
-from ..utils.db import get_or_create
+from ..utils.db import get_or_create, update_latest_predictors
 from ..database import db
 from ..models import (
     Predictor, PredictorCollection, PredictorEvent, PredictorRun,
@@ -89,6 +89,8 @@ def upload_collection(flask_app, filenames, runs, dataset_id, collection_id,
             collection_object.predictors.append(predictor)
 
         db.session.bulk_save_objects(pe_objects)
+        update_latest_predictors(
+            [p.id for p in collection_object.predictors], commit=False)
         db.session.commit()
     except Exception as e:
         cache.clear()
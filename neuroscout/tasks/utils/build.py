@@ -76,7 +76,8 @@ def build_analysis(analysis, predictor_events, bids_dir,
                    run_ids=None, build=True):
     """ Write out and build analysis object """
 
-    if predictor_events == []:
+    predictor_events = pd.DataFrame(predictor_events)
+    if predictor_events.empty:
         raise Exception("Error: Predictor events are null")
 
     tmp_dir = Path(mkdtemp())
@@ -85,7 +85,7 @@ def analysis_to_json(analysis_id, run_id=None):
 
     pes = dump_predictor_events(
         [(p['id']) for p in analysis_json['predictors']],
-        run_id
+        run_id, columnar=True
         )
 
     dataset_path = Path(analysis.dataset.local_path)
@@ -53,6 +53,20 @@ def test_get(session, auth_client, add_analysis):
     for required_fields in ['name', 'description']:
         assert analysis[required_fields] != ''
 
+    # Get full analysis, and streamed full analysis
+    resp = auth_client.get('/api/analyses/{}/full'.format(first_analysis_id))
+    assert resp.status_code == 200
+    full = decode_json(resp)
+    assert len(full['runs']) == 4
+
+    resp = auth_client.get('/api/analyses/{}/full'.format(first_analysis_id),
+                           params={'stream': 'true'})
+    assert resp.status_code == 200
+    streamed = decode_json(resp)
+    assert sorted(full['runs'], key=lambda r: r['id']) == streamed['runs']
+    assert {k: v for k, v in full.items() if k != 'runs'} == \
+        {k: v for k, v in streamed.items() if k != 'runs'}
+
     # Try getting nonexistent analysis
     resp = auth_client.get('/api/analyses/{}'.format(987654))
     assert resp.status_code == 404
@@ -2,7 +2,12 @@ from ..request_utils import decode_json
 from ...resources.predictor import prepare_upload
 from ...tasks.upload import upload_collection
 from ...core import app
+from ...models import Predictor
 from werkzeug.datastructures import FileStorage
+from io import BytesIO
+import gzip
+import json
+import pandas as pd
 
 
 def test_get_predictor(auth_client, extract_features):
@@ -81,6 +86,15 @@ def test_get_rextracted(auth_client, reextract):
         'run_id': run_id, 'newest': 'false'})
     assert len(decode_json(resp)) == 5
 
+    # Only the re-extracted Brightness predictor is the newest
+    resp = auth_client.get('/api/predictors', params={'run_id': run_id})
+    newest = decode_json(resp)
+    bright = [p for p in newest if p['name'] == 'Brightness']
+    assert len(newest) == 4
+    assert len(bright) == 1
+    assert bright[0]['id'] == max(
+        p.id for p in Predictor.query.filter_by(name='Brightness'))
+
 
 def test_predictor_create(session,
                           auth_client, add_users, add_task, get_data_path):
@@ -158,3 +172,39 @@ def test_get_predictor_data(auth_client, add_task, extract_features):
     assert resp.status_code == 200
     pe_list_filt = decode_json(resp)
     assert len(pe_list_filt) == 4
+
+    # Columnar formats
+    resp = auth_client.get(
+        '/api/predictor-events',
+        params={'predictor_id': ",".join(pids), 'format': 'tsv'},
+        headers={'Accept-Encoding': 'gzip', **auth_client._get_headers()})
+    assert resp.status_code == 200
+    assert resp.headers['Content-Encoding'] == 'gzip'
+    pe_tsv = pd.read_csv(BytesIO(gzip.decompress(resp.data)), sep='\t')
+    assert len(pe_tsv) == 52
+    assert {'onset', 'duration', 'value', 'run_id',
+            'predictor_id'} <= set(pe_tsv.columns)
+
+    # Not compressed unless the client accepts gzip
+    resp = auth_client.get(
+        '/api/predictor-events',
+        params={'predictor_id': ",".join(pids)},
+        headers={'Accept': 'text/tab-separated-values',
+                 **auth_client._get_headers()})
+    assert resp.status_code == 200
+    assert resp.mimetype == 'text/tab-separated-values'
+    assert 'Content-Encoding' not in resp.headers
+    assert len(pd.read_csv(BytesIO(resp.data), sep='\t')) == 52
+
+    resp = auth_client.get(
+        '/api/predictor-events',
+        params={'predictor_id': ",".join(pids), 'format': 'xml'})
+    assert resp.status_code == 422
+
+    # Streamed newline delimited JSON
+    resp = auth_client.get(
+        '/api/predictor-events',
+        params={'predictor_id': ",".join(pids), 'format': 'ndjson'})
+    assert resp.status_code == 200
+    pe_ndjson = [json.loads(l) for l in resp.data.decode().splitlines()]
+    assert len(pe_ndjson) == 52
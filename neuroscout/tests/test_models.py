@@ -1,12 +1,34 @@
 import pytest
+import hashlib
+import json
+import pickle
+from pathlib import Path
+from flask import current_app
 from sqlalchemy import func
 from ..models import (
     Analysis, User, Dataset, Predictor, Stimulus, Run, RunStimulus,
-    ExtractedFeature, PredictorEvent, GroupPredictor, Task)
+    ExtractedFeature, ExtractedEvent, PredictorEvent, GroupPredictor, Task,
+    LatestPredictor, ExtractionCheckpoint)
 
+import numpy as np
+import nibabel as nib
 from numpy import isclose
+from pliers.graph import Graph
+from pliers.stimuli import ComplexTextStim, TextStim
+from bids.layout import BIDSLayout
+from .. import populate
+from ..populate import extract, ingest
+from ..populate.annotate import FeatureSerializer
 from ..populate.convert import ingest_text_stimuli
-from ..populate.modify import update_annotations
+from ..populate.utils import (probe_nifti_duration, hash_stim,
+                              get_cached, set_cached, prune_cache,
+                              compute_pred_stats)
+from ..populate.modify import (update_annotations,
+                               materialize_predictor_events,
+                               recompute_predictor_stats)
+from ..utils.db import dump_predictor_events, copy_insert
+from ..resources.predictor import get_predictors
+from .conftest import DATASET_PATH, EXTRACTORS
 
 
 def test_dataset_ingestion(session, add_task):
@@ -61,6 +83,74 @@ def test_dataset_ingestion(session, add_task):
     assert GroupPredictor.query.filter_by(name='sex').count() == 1
 
 
+def test_parallel_task_ingestion(session):
+    dataset_id = populate.add_dataset(
+        'Test Dataset', 'example dataset', '///datalad/preproc/address',
+        DATASET_PATH)
+    populate.add_task('bidstest', 'Test Dataset', DATASET_PATH, n_jobs=2)
+
+    dataset_model = Dataset.query.filter_by(id=dataset_id).one()
+    assert len(dataset_model.runs) == 4
+    assert dataset_model.predictors.count() == 3
+    predictor = Predictor.query.filter_by(name='rt').first()
+    assert len(predictor.predictor_events) == 16
+    assert Stimulus.query.count() == 4
+    assert RunStimulus.query.count() == 16
+
+
+def test_probe_nifti_duration(tmpdir):
+    data = np.zeros((2, 2, 2, 10), dtype='float32')
+    for ext in ['nii', 'nii.gz']:
+        path = str(tmpdir / 'bold.{}'.format(ext))
+        img = nib.Nifti1Image(data, np.eye(4))
+        img.header.set_zooms((3, 3, 3, 1.5))
+        img.to_filename(path)
+        assert probe_nifti_duration(path) == 15
+
+    empty = tmpdir / 'empty.nii.gz'
+    empty.write('')
+    with pytest.raises(ValueError):
+        probe_nifti_duration(str(empty))
+
+
+def test_parse_run_probe_first(app, monkeypatch):
+    calls = []
+    monkeypatch.setattr(ingest, 'get', lambda path: calls.append('get'))
+    monkeypatch.setattr(ingest, 'drop', lambda path: calls.append('drop'))
+    monkeypatch.setattr(ingest, '_layout', BIDSLayout(
+        str(DATASET_PATH), derivatives=True))
+    img_path = str(next(DATASET_PATH.glob('sub-*/func/*_bold.nii.gz')))
+
+    # Images are not fetched if their header can be probed
+    monkeypatch.setattr(ingest, 'probe_nifti_duration', lambda path: 15.0)
+    parsed = ingest._parse_run(img_path, 'bidstest', 1, auto_fetch=True)
+    assert parsed['duration'] == 15.0
+    assert calls == []
+
+    def probe_missing(path):
+        if 'get' not in calls:
+            raise FileNotFoundError(path)
+        return 20.0
+    monkeypatch.setattr(ingest, 'probe_nifti_duration', probe_missing)
+    parsed = ingest._parse_run(img_path, 'bidstest', 1, auto_fetch=True)
+    assert parsed['duration'] == 20.0
+    assert calls == ['get', 'drop']
+
+
+def test_hash_stim_file(tmpdir):
+    path = tmpdir / 'stim.bin'
+    path.write_binary(b'x' * 3000000)
+    assert hash_stim(str(path)) == hashlib.sha1(b'x' * 3000000).hexdigest()
+
+    cache = {}
+    set_cached(cache, str(path), 'abc')
+    assert get_cached(cache, str(path)) == 'abc'
+
+    # Modified files are not found in the cache
+    path.write_binary(b'y')
+    assert get_cached(cache, str(path)) is None
+
+
 def test_json_local_dataset(session, add_local_task_json):
     dataset_model = Dataset.query.filter_by(id=add_local_task_json).one()
 
@@ -118,6 +208,166 @@ def test_extracted_features(session, add_task, extract_features):
         extractor_name='SharpnessExtractor').count() == 1
 
 
+def test_extraction_cache(session, add_task, extract_features):
+    cache_dir = current_app.config['EXTRACTION_CACHE']
+    assert list(Path(cache_dir).glob('*/*'))
+
+    # Cached results are identical to extracted results
+    n_events = ExtractedEvent.query.count()
+    populate.extract_features(EXTRACTORS, 'Test Dataset', 'bidstest')
+    assert ExtractedEvent.query.count() == n_events * 2
+
+    prune_cache(cache_dir, 0)
+    assert not list(Path(cache_dir).glob('*/*'))
+
+
+def test_extraction_cache_hash_seed(session, add_task, extract_features):
+    cache_dir = Path(current_app.config['EXTRACTION_CACHE'])
+    paths = sorted(cache_dir.glob('*/*'))
+    assert len(paths) > 1
+
+    # Results cached by another process (with a different str hash seed)
+    # have different feature hashes
+    for path in paths[::2]:
+        with path.open('rb') as f:
+            result = pickle.load(f)
+        for ser in result:
+            for ef_props, _ in ser:
+                ef_props['sha1_hash'] = hashlib.sha1(
+                    ef_props['sha1_hash'].encode()).hexdigest()
+        with path.open('wb') as f:
+            pickle.dump(result, f)
+    for path in paths[1::2]:
+        path.unlink()
+
+    # Cached and freshly extracted results share features
+    n_bright = ExtractedFeature.query.filter_by(
+        feature_name='Brightness').count()
+    populate.extract_features(EXTRACTORS, 'Test Dataset', 'bidstest')
+    assert ExtractedFeature.query.filter_by(
+        feature_name='Brightness').count() == n_bright + 1
+
+
+def test_incremental_extraction(session, add_task, extract_features):
+    n_events = ExtractedEvent.query.count()
+    assert populate.extract_features(
+        EXTRACTORS, 'Test Dataset', 'bidstest', incremental=True) == []
+    assert ExtractedEvent.query.count() == n_events
+
+    # Remove events for one stimulus, and extract again
+    ef_b = ExtractedFeature.query.filter_by(
+        extractor_name='BrightnessExtractor').one()
+    stim_id = ef_b.extracted_events[0].stimulus_id
+    ExtractedEvent.query.filter_by(stimulus_id=stim_id).delete()
+    session.commit()
+
+    populate.extract_features(
+        EXTRACTORS, 'Test Dataset', 'bidstest', incremental=True)
+    assert ExtractedEvent.query.count() == n_events
+    # New events were added to the existing feature and predictor
+    assert ExtractedFeature.query.filter_by(
+        extractor_name='BrightnessExtractor').count() == 1
+    assert Predictor.query.filter_by(ef_id=ef_b.id).count() == 1
+
+
+def test_extraction_checkpoint(session, add_task, monkeypatch):
+    # Interrupt extraction after all results are written
+    def interrupt(*args, **kwargs):
+        raise RuntimeError("Interrupted")
+    monkeypatch.setattr(extract, 'create_predictors', interrupt)
+    with pytest.raises(RuntimeError):
+        populate.extract_features(
+            EXTRACTORS, 'Test Dataset', 'bidstest', batch_size=1)
+    monkeypatch.undo()
+
+    n_events = ExtractedEvent.query.count()
+    assert n_events > 0
+
+    # Resuming does not extract stimuli again
+    populate.extract_features(
+        EXTRACTORS, 'Test Dataset', 'bidstest', batch_size=1)
+    assert ExtractedEvent.query.count() == n_events
+    assert Predictor.query.filter_by(name='Brightness').count() == 1
+    assert ExtractionCheckpoint.query.count() == 0
+
+
+def test_extraction_checkpoint_plan(session, add_task):
+    key = extract._checkpoint_key(
+        EXTRACTORS, 'Test Dataset', 'bidstest', False, {})
+    session.add(ExtractionCheckpoint(
+        key=key, plan_hash='stale', stimuli=[0], features=[]))
+    session.commit()
+
+    # Checkpoints of a different plan are not resumed
+    checkpoint = extract._load_checkpoint(key, 'current')
+    assert checkpoint.stimuli == []
+    assert ExtractionCheckpoint.query.count() == 0
+
+
+def test_parallel_extraction(session, add_task):
+    populate.extract_features(
+        EXTRACTORS, 'Test Dataset', 'bidstest', n_jobs=2, use_cache=False)
+
+    bright = ExtractedFeature.query.filter_by(
+        feature_name='Brightness').one()
+    image_ids = set(s.id for s in Stimulus.query.filter(
+        Stimulus.mimetype.like('image%')))
+    assert set(ee.stimulus_id for ee in bright.extracted_events) == image_ids
+    assert Predictor.query.filter_by(name='Brightness').count() == 1
+
+
+def test_extraction_unit(session, add_task):
+    extraction_id = 'test-extraction'
+    serializer = FeatureSerializer()
+    stims = Stimulus.query.filter(Stimulus.mimetype.like('image%')).all()
+
+    results = {
+        stim.id: extract._extract_to_serial(
+            [Graph(EXTRACTORS[0])], stim, serializer)
+        for stim in stims}
+    ef_ids = [extract.write_extraction_unit(stim_id, res, extraction_id)
+              for stim_id, res in results.items()]
+    n_events = ExtractedEvent.query.count()
+
+    # Units share features, and retrying a unit replaces its events
+    assert len(set(map(tuple, ef_ids))) == 1
+    assert ExtractedFeature.query.count() == len(ef_ids[0])
+    assert extract.write_extraction_unit(
+        stims[0].id, results[stims[0].id], extraction_id) == ef_ids[0]
+    assert ExtractedEvent.query.count() == n_events
+
+    # Other extractions do not share them
+    other = extract.write_extraction_unit(
+        stims[0].id, results[stims[0].id], 'other-extraction')
+    assert set(other).isdisjoint(ef_ids[0])
+
+
+def test_recompute_predictor_stats(session, add_task):
+    dataset = Dataset.query.filter_by(id=add_task).one()
+    run = dataset.runs[0]
+    numeric = Predictor(name='numeric', dataset_id=dataset.id)
+    categorical = Predictor(name='categorical', dataset_id=dataset.id)
+    session.add_all([numeric, categorical])
+    session.commit()
+    for pred, values in [(numeric, ['1', '3', 'n/a']),
+                         (categorical, ['a', '1'])]:
+        session.add_all([
+            PredictorEvent(predictor_id=pred.id, run_id=run.id, onset=i,
+                           duration=1, value=v)
+            for i, v in enumerate(values)])
+    session.commit()
+
+    recompute_predictor_stats('Test Dataset')
+
+    assert (numeric.max, numeric.min, numeric.num_na) == (3, 1, 1)
+    assert isclose(numeric.mean, 2)
+    assert categorical.max is None and categorical.num_na is None
+
+    rt = Predictor.query.filter_by(name='rt').one()
+    assert rt.num_na == 0
+    assert rt.min <= rt.mean <= rt.max
+
+
 def test_analysis(session, add_analysis, add_predictor):
     # Number of entries
     assert Analysis.query.count() == 1
@@ -171,6 +421,53 @@ def test_external_text(get_data_path, add_task):
     assert 2.2 in [s.onset for s in first_stim.run_stimuli.all()]
 
 
+def test_load_transcripts(session, get_data_path, add_task):
+    dataset_model = Dataset.query.filter_by(id=add_task).one()
+    task_name = Task.query.filter_by(dataset_id=add_task).one().name
+    stim = [s for s in Stimulus.query.filter_by(dataset_id=add_task)
+            if 'obama' in s.path][0]
+    ingest_text_stimuli(
+        (get_data_path / 'fake_transcript.csv').as_posix(),
+        dataset_model.name, task_name, stim.id,
+        transformer='FakeTextExtraction')
+
+    run_id = stim.run_stimuli.first().run_id
+    transcript = Stimulus(
+        sha1_hash='transcript', mimetype='text/csv', content='no yes',
+        dataset_id=add_task)
+    session.add(transcript)
+    session.commit()
+    session.add(RunStimulus(
+        stimulus_id=transcript.id, run_id=run_id, onset=1, duration=10))
+    session.commit()
+
+    words = RunStimulus.query.filter_by(run_id=run_id).join(
+        Stimulus).filter(Stimulus.mimetype == 'text/plain').order_by(
+            RunStimulus.onset).all()
+
+    stims = extract._load_complex_text_stim_models(
+        dataset_model.name, task_name)
+    assert len(stims) == 1
+    stim_model, cts = stims[0]
+    assert stim_model.id == transcript.id
+    assert [e.onset for e in cts.elements] == [w.onset - 1 for w in words]
+    assert [e.text for e in cts.elements] == [
+        w.stimulus.content for w in words]
+
+
+def test_window_batches():
+    cts = ComplexTextStim(elements=[
+        TextStim(text=str(i), onset=i, duration=1) for i in range(5)])
+
+    windows = extract._iter_windows(cts, 3)
+    batches = list(extract._batched(windows, 2))
+
+    assert [len(b) for b in batches] == [2, 1]
+    assert [[e.text for e in w.elements] for b in batches for w in b] == [
+        ['0', '1', '2'], ['1', '2', '3'], ['2', '3', '4']]
+    assert list(extract._iter_windows(cts, 6)) == []
+
+
 def test_update_schema(session, add_task, extract_features):
     bright = ExtractedFeature.query.filter_by(
         feature_name='Brightness').one()
@@ -199,3 +496,92 @@ def test_update_schema(session, add_task, extract_features):
     assert Predictor.query.filter_by(name='REACTION_TIME').count() == 0
     predictor = Predictor.query.filter_by(name='rt').first()
     assert predictor.name == 'rt'
+
+
+def test_update_schema_newest(session, app, add_task, tmp_path,
+                              monkeypatch):
+    schema = tmp_path / 'predictor_schema.json'
+    schema.write_text(json.dumps({
+        "reaction_time$": {"name": "reaction"}}))
+    monkeypatch.setitem(app.config, 'PREDICTOR_SCHEMA', schema)
+
+    newest = {p.id for p in get_predictors(name=['rt'])}
+    assert newest
+
+    update_annotations()
+
+    assert get_predictors(name=['rt']) == []
+    assert {p.id for p in get_predictors(name=['reaction'])} == newest
+    assert LatestPredictor.query.filter_by(name='rt').count() == 0
+
+
+def test_pred_stats_out_of_range(session, add_task):
+    predictor = Predictor.query.filter_by(name='rt').first()
+    run = Run.query.first()
+    for value in ['1e400', '-1e400', '1e-400', '9' * 400]:
+        session.add(PredictorEvent(
+            onset=0, duration=1, value=value,
+            predictor_id=predictor.id, run_id=run.id))
+    session.commit()
+
+    # Values out of float range are not numeric, rather than failing
+    compute_pred_stats(session, [predictor.id], commit=True)
+    assert predictor.max is None
+
+
+def test_copy_insert(session, add_task):
+    predictor = Predictor.query.filter_by(name='rt').first()
+    run = Run.query.first()
+    n_pes = PredictorEvent.query.count()
+
+    n_rows = copy_insert(PredictorEvent.__table__, [
+        dict(onset=np.arange(3) * 2.0, duration=2.0,
+             value=np.array(['a\tb', 'c\\d', 'n/a'], dtype=object),
+             predictor_id=predictor.id, run_id=run.id),
+        dict(onset=[], duration=[], value=[],
+             predictor_id=predictor.id, run_id=run.id)
+    ])
+    session.commit()
+
+    assert n_rows == 3
+    assert PredictorEvent.query.count() == n_pes + 3
+    pes = PredictorEvent.query.filter(
+        PredictorEvent.run_id == run.id,
+        PredictorEvent.predictor_id == predictor.id,
+        PredictorEvent.value.in_(['a\tb', 'c\\d', 'n/a'])).order_by(
+            PredictorEvent.onset).all()
+    assert [pe.value for pe in pes] == ['a\tb', 'c\\d', 'n/a']
+    assert [pe.onset for pe in pes] == [0, 2, 4]
+    assert all(pe.duration == 2 and pe.stimulus_id is None for pe in pes)
+
+
+def test_dump_predictor_events(session, add_task, extract_features):
+    pred_ids = [p.id for p in Predictor.query.all()]
+    records = dump_predictor_events(pred_ids, stimulus_timing=True)
+    columnar = dump_predictor_events(
+        pred_ids, stimulus_timing=True, columnar=True)
+
+    assert len(records) == len(columnar['onset'])
+    assert set(columnar.keys()) == set(records[0].keys())
+
+    # Extracted events are relative to the run, using stimulus timing
+    bright = Predictor.query.filter_by(name='Brightness').one()
+    extracted = [r for r in records if r['predictor_id'] == bright.id]
+    assert len(extracted) == RunStimulus.query.count()
+    for pe in extracted:
+        assert pe['onset'] >= pe['stimulus_onset']
+        assert '/' not in pe['stimulus_path']
+
+    # Filter by run
+    run_id = extracted[0]['run_id']
+    filtered = dump_predictor_events([bright.id], [run_id], columnar=True)
+    assert set(filtered['run_id']) == {run_id}
+
+    # Materialized events are identical to those computed on the fly
+    materialize_predictor_events('Test Dataset')
+    assert Predictor.query.filter_by(id=bright.id).one().materialized
+    materialized = dump_predictor_events(pred_ids, stimulus_timing=True)
+
+    def _key(pe):
+        return sorted((k, str(v)) for k, v in pe.items())
+    assert sorted(map(_key, materialized)) == sorted(map(_key, records))
@@ -0,0 +1,61 @@
+""" Background fetching of annexed stimuli """
+import shutil
+import threading
+import pytest
+
+from ..populate import prefetch
+from ..populate.prefetch import Prefetcher, needs_fetch
+
+
+def test_prefetch_window(tmp_path, monkeypatch):
+    paths = []
+    for i in range(6):
+        path = tmp_path / str(i)
+        path.symlink_to(tmp_path / 'missing-{}'.format(i))
+        paths.append(str(path))
+
+    fetched = []
+    lock = threading.Lock()
+
+    def fake_get(path):
+        with lock:
+            fetched.append(path)
+
+    monkeypatch.setattr(prefetch, 'get', fake_get)
+    monkeypatch.setattr(prefetch, 'drop', lambda path: None)
+
+    with Prefetcher(list(enumerate(paths)), ahead=2) as prefetcher:
+        prefetcher.wait(0)
+        prefetcher.wait(1)
+        # No more than 2 files are fetched before being released
+        assert not prefetcher._ready[2].wait(0.1)
+        assert fetched == paths[:2]
+
+        prefetcher.release(0)
+        prefetcher.release(1)
+        for key in range(2, 6):
+            prefetcher.wait(key)
+            prefetcher.release(key)
+    assert fetched == paths
+
+
+@pytest.mark.skipif(shutil.which('git-annex') is None,
+                    reason="git-annex is not installed")
+def test_prefetch_annex(tmp_path):
+    from datalad.api import create, clone
+
+    origin = create(str(tmp_path / 'origin'))
+    (tmp_path / 'origin' / 'stim.txt').write_text('some stimulus')
+    origin.save(message='Add stimulus')
+
+    clone(source=str(tmp_path / 'origin'), path=str(tmp_path / 'clone'))
+    path = str(tmp_path / 'clone' / 'stim.txt')
+    assert needs_fetch(path)
+
+    with Prefetcher([(1, path)], ahead=1, drop_after=True) as prefetcher:
+        prefetcher.wait(1)
+        with open(path) as f:
+            assert f.read() == 'some stimulus'
+        prefetcher.release(1)
+
+    assert needs_fetch(path)
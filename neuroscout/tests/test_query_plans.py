@@ -0,0 +1,133 @@
+""" Query plan regression tests.
+Seed unrelated rows so that the test data is a small fraction of each
+table, ANALYZE, and check that the planner chooses the expected index
+for the hot queries. """
+import pytest
+from sqlalchemy.dialects import postgresql
+from ..models import Analysis, Predictor, PredictorRun, Run, RunStimulus
+from ..resources.predictor import predictors_query
+from ..utils.db import _predictor_events_query
+
+INDEX_SCANS = ('Index Scan', 'Index Only Scan', 'Bitmap Index Scan')
+
+FILLER = [
+    """INSERT INTO run (task_id, dataset_id, subject, number, active)
+       SELECT :task_id, :dataset_id, 'filler', n, false
+       FROM generate_series(1, 100) n""",
+    """INSERT INTO predictor (name, dataset_id, active, private,
+                              materialized)
+       SELECT 'filler_' || n, :dataset_id, false, false, false
+       FROM generate_series(1, 100) n""",
+    """INSERT INTO extracted_feature (sha1_hash, feature_name)
+       SELECT 'filler_' || n, 'filler_' || n
+       FROM generate_series(1, 100) n""",
+    """INSERT INTO predictor_event (onset, duration, value, run_id,
+                                    predictor_id)
+       SELECT e, 1, '0', r.id, p.id
+       FROM run r, predictor p, generate_series(1, 5) e
+       WHERE r.subject = 'filler' AND p.name LIKE 'filler\\_%'""",
+    """INSERT INTO extracted_predictor_event (onset, duration, value,
+                                              run_id, predictor_id)
+       SELECT e, 1, '0', r.id, p.id
+       FROM run r, predictor p, generate_series(1, 5) e
+       WHERE r.subject = 'filler' AND p.name LIKE 'filler\\_%'""",
+    """INSERT INTO predictor_run (run_id, predictor_id)
+       SELECT r.id, p.id FROM run r, predictor p
+       WHERE r.subject = 'filler' AND p.name LIKE 'filler\\_%'""",
+    """INSERT INTO run_stimulus (stimulus_id, run_id, onset, duration)
+       SELECT :stimulus_id, r.id, e, 1
+       FROM run r, generate_series(1, 100) e
+       WHERE r.subject = 'filler'""",
+    """INSERT INTO extracted_event (onset, duration, value, ef_id,
+                                    stimulus_id)
+       SELECT e, 1, '0', ef.id, :stimulus_id
+       FROM extracted_feature ef, generate_series(1, 100) e
+       WHERE ef.sha1_hash LIKE 'filler\\_%'""",
+    """INSERT INTO analysis (hash_id, name, dataset_id, user_id)
+       SELECT 'filler_' || n, 'filler', :dataset_id, :user_id
+       FROM generate_series(1, 10000) n""",
+]
+
+ANALYZED = ['run', 'predictor', 'extracted_feature', 'predictor_event',
+            'extracted_predictor_event', 'predictor_run', 'run_stimulus',
+            'extracted_event', 'analysis']
+
+
+@pytest.fixture(scope='function')
+def filler(session, add_analysis):
+    run = Run.query.first()
+    params = {
+        'task_id': run.task_id,
+        'dataset_id': run.dataset_id,
+        'stimulus_id': RunStimulus.query.first().stimulus_id,
+        'user_id': Analysis.query.first().user_id,
+    }
+    for statement in FILLER:
+        session.execute(statement, params)
+    for table in ANALYZED:
+        session.execute(f'ANALYZE {table}')
+
+
+def _walk(node):
+    yield node
+    for child in node.get('Plans', []):
+        yield from _walk(child)
+
+
+def indexes_used(session, statement):
+    """ Return names of indexes scanned in query plan """
+    if hasattr(statement, 'statement'):
+        statement = statement.statement
+    compiled = statement.compile(dialect=postgresql.dialect())
+
+    plan = session.connection().execute(
+        'EXPLAIN (FORMAT JSON) ' + str(compiled), compiled.params).scalar()
+
+    return {node['Index Name'] for node in _walk(plan[0]['Plan'])
+            if node['Node Type'] in INDEX_SCANS}
+
+
+def _test_ids():
+    pred_ids = [p.id for p in Predictor.query.filter(
+        ~Predictor.name.like('filler\\_%'))]
+    run_ids = [r.id for r in Run.query.filter(Run.subject != 'filler')]
+    return pred_ids, run_ids
+
+
+def test_predictor_events_plan(session, filler):
+    pred_ids, run_ids = _test_ids()
+    expected = {'idx_pe_predictor_id_run_id', 'idx_epe_predictor_id_run_id',
+                'idx_ef_id'}
+    for timing in [False, True]:
+        _, statement = _predictor_events_query(
+            pred_ids, run_ids, stimulus_timing=timing)
+        assert expected <= indexes_used(session, statement)
+
+        _, statement = _predictor_events_query(
+            pred_ids, stimulus_timing=timing)
+        assert expected <= indexes_used(session, statement)
+
+
+def test_predictors_plan(session, filler):
+    _, run_ids = _test_ids()
+    for newest in [True, False]:
+        query = predictors_query(newest=newest, run_id=run_ids)
+        assert 'predictor_run_pkey' in indexes_used(session, query)
+
+
+def test_association_plans(session, filler):
+    run = Run.query.filter(Run.subject != 'filler').first()
+    predictor = Predictor.query.filter_by(name='rt').first()
+    analysis = Analysis.query.filter(Analysis.name != 'filler').first()
+
+    for query, index in [
+            (RunStimulus.query.filter_by(run_id=run.id), 'idx_rs_run_id'),
+            (PredictorRun.query.filter_by(run_id=run.id),
+             'predictor_run_pkey'),
+            (PredictorRun.query.filter_by(predictor_id=predictor.id),
+             'idx_pr_predictor_id'),
+            (run.predictor_events.filter_by(predictor_id=predictor.id),
+             'idx_pe_predictor_id_run_id'),
+            (Analysis.query.filter_by(hash_id=analysis.hash_id),
+             'analysis_hash_id_key')]:
+        assert index in indexes_used(session, query)
@@ -0,0 +1,165 @@
+""" Remote API extraction limits, tested against a local mock API """
+import time
+import threading
+import pytest
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.request import urlopen
+from urllib.error import HTTPError
+
+from ..populate.remote import TokenBucket, RemoteLimiter
+
+
+class MockAPI(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, fail_first=0, delay=0, status=429):
+        super().__init__(('127.0.0.1', 0), MockHandler)
+        self.fail_first = fail_first
+        self.status = status
+        self.delay = delay
+        self.requests = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/'.format(self.server_port)
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            server.in_flight += 1
+            server.max_in_flight = max(
+                server.max_in_flight, server.in_flight)
+            failing = server.requests <= server.fail_first
+        time.sleep(server.delay)
+        with server.lock:
+            server.in_flight -= 1
+
+        self.send_response(server.status if failing else 200)
+        self.end_headers()
+        self.wfile.write(b'' if failing else b'ok')
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def mock_api():
+    servers = []
+
+    def _start(**kwargs):
+        server = MockAPI(**kwargs)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+    yield _start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def _get(url):
+    with urlopen(url) as response:
+        return response.read()
+
+
+def _call_all(limiter, url, n):
+    results = []
+    threads = [
+        threading.Thread(
+            target=lambda: results.append(limiter.call('mock', _get, url)))
+        for _ in range(n)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=50, capacity=5)
+    start = time.monotonic()
+    for _ in range(20):
+        bucket.acquire()
+    # Burst of 5, then 15 more at 50 per second
+    assert time.monotonic() - start >= 0.25
+
+
+def test_retry_with_backoff(mock_api):
+    api = mock_api(fail_first=2)
+    limiter = RemoteLimiter(max_retries=3, backoff=0.01)
+
+    assert limiter.call('mock', _get, api.url) == b'ok'
+    assert api.requests == 3
+
+    api = mock_api(fail_first=10)
+    limiter = RemoteLimiter(max_retries=1, backoff=0.01)
+    with pytest.raises(HTTPError):
+        limiter.call('mock', _get, api.url)
+    assert api.requests == 2
+
+
+def test_retry_transient(mock_api):
+    # Client errors are not retried
+    api = mock_api(fail_first=1, status=404)
+    limiter = RemoteLimiter(max_retries=3, backoff=0.01)
+    with pytest.raises(HTTPError):
+        limiter.call('mock', _get, api.url)
+    assert api.requests == 1
+
+    api = mock_api(fail_first=1, status=503)
+    assert limiter.call('mock', _get, api.url) == b'ok'
+    assert api.requests == 2
+
+    # Unless configured
+    api = mock_api(fail_first=1, status=404)
+    limiter = RemoteLimiter.from_config(
+        {'max_retries': 3, 'backoff': 0.01,
+         'retry_on': ['urllib.error.HTTPError']})
+    assert limiter.call('mock', _get, api.url) == b'ok'
+    assert api.requests == 2
+
+    calls = []
+
+    def fail():
+        calls.append(1)
+        raise ValueError
+    with pytest.raises(ValueError):
+        limiter.call('mock', fail)
+    assert len(calls) == 1
+
+    # Permanent OS errors are not retried
+    def missing():
+        calls.append(1)
+        raise FileNotFoundError
+    with pytest.raises(FileNotFoundError):
+        limiter.call('mock', missing)
+    assert len(calls) == 2
+
+
+def test_provider_limits(mock_api):
+    api = mock_api(delay=0.05)
+    limiter = RemoteLimiter(
+        {'mock': {'concurrency': 3}, 'default': {'concurrency': 1}})
+
+    assert _call_all(limiter, api.url, 12) == [b'ok'] * 12
+    assert api.max_in_flight == 3
+
+    # Rate limits apply across threads
+    api = mock_api()
+    limiter = RemoteLimiter({'default': {'rate': 40, 'burst': 1}})
+    start = time.monotonic()
+    _call_all(limiter, api.url, 9)
+    assert time.monotonic() - start >= 0.2
+
+    # Local extraction (without a provider) is not limited
+    start = time.monotonic()
+    for _ in range(9):
+        limiter.call(None, lambda: None)
+    assert time.monotonic() - start < 0.2
@@ -3,11 +3,17 @@
 """
 from flask import abort, current_app
 from sqlalchemy.exc import SQLAlchemyError, IntegrityError
-from ..models import (Analysis, RunStimulus, Predictor, PredictorEvent,
-                      ExtractedEvent, Stimulus, Report)
+from ..models import (Analysis, Run, RunStimulus, Predictor, PredictorEvent,
+                      PredictorRun, LatestPredictor, ExtractedEvent,
+                      ExtractedPredictorEvent, Stimulus, Report)
 from ..database import db
+from sqlalchemy import (select, union_all, func, cast, null, tuple_, or_,
+                        Float, Text)
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.event import listens_for
-from sqlalchemy.dialects import postgresql
+from io import StringIO
+import numpy as np
+import pandas as pd
 import shortuuid
 
 
@@ -21,92 +27,243 @@ def delete_analysis(analysis):
     db.session.commit()
 
 
-def create_pes(predictors, run_ids=None, stimulus_timing=False):
-    """ Create PredictorEvents from EFs """
-    all_pes = []
-    for pred in predictors:
-        ef = pred.extracted_feature
-        # For all instances for stimuli in this task's runs
-        query = ExtractedEvent.query.filter_by(
-            ef_id=ef.id).join(Stimulus).join(
-                RunStimulus)
-
-        if run_ids is not None:
-            query = query.filter(RunStimulus.run_id.in_(run_ids))
-
-        query = query.with_entities(
-            'extracted_event.onset', 'extracted_event.duration',
-            'extracted_event.value', 'extracted_event.object_id',
-            'extracted_event.stimulus_id', 'run_stimulus.run_id',
-            'run_stimulus.onset', 'run_stimulus.duration',
-            'stimulus.path')
-
-        for (onset, dur, val, o_id, s_id, run_id, rs_onset, rs_dur, s_path) \
-                in query:
-            if dur is None:
-                dur = rs_dur
-            s_path = s_path.split('/')[-1] if s_path else None
-
-            res = dict(
-                    onset=(onset or 0) + rs_onset,
-                    duration=dur,
-                    value=val,
-                    run_id=run_id,
-                    predictor_id=pred.id,
-                    object_id=o_id,
-                )
-
-            if stimulus_timing:
-                res.update(dict(
-                    stimulus_id=s_id,
-                    stimulus_onset=rs_onset,
-                    stimulus_duration=rs_dur,
-                    stimulus_path=s_path
-                    )
-                )
-
-            all_pes.append(res)
-    return all_pes
-
-
-def dump_pe(pes):
-    """ Serialize PredictorEvents, with *SPEED*, using core SQL.
-    Warning: relies on attributes being in correct order. """
-    statement = str(pes.statement.compile(dialect=postgresql.dialect()))
-    params = pes.statement.compile(dialect=postgresql.dialect()).params
-    res = db.session.connection().execute(statement, params)
-    return [
-        dict(
-            zip(('id', 'onset', 'duration', 'value', 'object_id', 'run_id',
-                 'predictor_id', 'stimulus_id'), r))
-        for r in res
+PE_COLUMNS = ('onset', 'duration', 'value', 'object_id', 'run_id',
+              'predictor_id', 'stimulus_id')
+STIMULUS_TIMING_COLUMNS = ('stimulus_onset', 'stimulus_duration',
+                           'stimulus_path')
+
+
+def _raw_pes(predictor_ids, run_ids=None, stimulus_timing=False):
+    """ Core SQL query for PredictorEvents of raw (ingested) Predictors """
+    pe = PredictorEvent.__table__
+    columns = [pe.c[c] for c in PE_COLUMNS]
+    if stimulus_timing:
+        columns += [
+            cast(null(), Float).label('stimulus_onset'),
+            cast(null(), Float).label('stimulus_duration'),
+            cast(null(), Text).label('stimulus_path')
         ]
 
+    query = select(columns).where(pe.c.predictor_id.in_(predictor_ids))
+    if run_ids is not None:
+        query = query.where(pe.c.run_id.in_(run_ids))
+    return query
+
+
+def _materialized_pes(predictor_ids, run_ids=None, stimulus_timing=False):
+    """ Core SQL query for materialized PredictorEvents of extracted
+    Predictors """
+    epe = ExtractedPredictorEvent.__table__
+    stim = Stimulus.__table__
+    columns = [epe.c[c] for c in PE_COLUMNS]
+    source = epe
+    if stimulus_timing:
+        columns += [
+            epe.c.stimulus_onset,
+            epe.c.stimulus_duration,
+            func.regexp_replace(stim.c.path, '^.*/', '').label(
+                'stimulus_path')
+        ]
+        source = epe.outerjoin(stim, stim.c.id == epe.c.stimulus_id)
 
-def dump_predictor_events(predictor_ids, run_ids=None, stimulus_timing=False):
-    """ Query & serialize PredictorEvents, for both Raw and Extracted
-    Predictors (which require creating PEs from EEs)
-    """
+    query = select(columns).select_from(source).where(
+        epe.c.predictor_id.in_(predictor_ids))
+    if run_ids is not None:
+        query = query.where(epe.c.run_id.in_(run_ids))
+    return query
+
+
+def create_pes(predictor_ids, run_ids=None, stimulus_timing=False,
+               include_materialized=False):
+    """ Create PredictorEvents from EFs, as a single set-based query.
+    Onsets and durations are computed relative to the run in SQL, by
+    joining ExtractedEvents to their RunStimulus associations.
+    Predictors with materialized events are skipped, unless
+    include_materialized is True. """
+    ee = ExtractedEvent.__table__
+    rs = RunStimulus.__table__
+    pred = Predictor.__table__
+    stim = Stimulus.__table__
+
+    columns = [
+        (func.coalesce(ee.c.onset, 0) + rs.c.onset).label('onset'),
+        func.coalesce(ee.c.duration, rs.c.duration).label('duration'),
+        ee.c.value,
+        ee.c.object_id,
+        rs.c.run_id,
+        pred.c.id.label('predictor_id'),
+        ee.c.stimulus_id
+    ]
+    if stimulus_timing:
+        columns += [
+            rs.c.onset.label('stimulus_onset'),
+            rs.c.duration.label('stimulus_duration'),
+            func.regexp_replace(stim.c.path, '^.*/', '').label(
+                'stimulus_path')
+        ]
+
+    query = select(columns).select_from(
+        pred.join(ee, ee.c.ef_id == pred.c.ef_id).join(
+            stim, stim.c.id == ee.c.stimulus_id).join(
+                rs, rs.c.stimulus_id == stim.c.id)).where(
+                    pred.c.id.in_(predictor_ids))
 
-    # Query Predictors
-    all_preds = Predictor.query.filter(Predictor.id.in_(predictor_ids))
+    if not include_materialized:
+        query = query.where(pred.c.materialized.isnot(True))
+    if run_ids is not None:
+        query = query.where(rs.c.run_id.in_(run_ids))
+    return query
 
-    # Separate raw and extracted predictors
-    raw_pred_ids = [p.id for p in all_preds.filter_by(ef_id=None)]
-    ext_preds = Predictor.query.filter(
-        Predictor.id.in_(set(predictor_ids) - set(raw_pred_ids)))
 
-    # Query & dump raw PEs
-    pes = PredictorEvent.query.filter(
-        (PredictorEvent.predictor_id.in_(raw_pred_ids)))
+def materialize_pes(predictor_ids, run_ids=None, commit=True):
+    """ Materialize PredictorEvents of extracted Predictors into the
+    ExtractedPredictorEvent table. Existing events for these Predictors
+    (restricted to run_ids, if given) are replaced, so this can also be used
+    to incrementally refresh the store when new runs are linked.
+    Args:
+        predictor_ids - list of extracted Predictor ids
+        run_ids - optional list (or query) of Run ids to refresh
+        commit - commit session
+    """
+    epe = ExtractedPredictorEvent.__table__
+    delete = epe.delete().where(epe.c.predictor_id.in_(predictor_ids))
     if run_ids is not None:
-        pes = pes.filter((PredictorEvent.run_id.in_(run_ids)))
+        delete = delete.where(epe.c.run_id.in_(run_ids))
+    db.session.execute(delete)
+
+    columns = PE_COLUMNS + STIMULUS_TIMING_COLUMNS[:2]
+    pes = create_pes(predictor_ids, run_ids, stimulus_timing=True,
+                     include_materialized=True).alias()
+    db.session.execute(epe.insert().from_select(
+        columns, select([pes.c[c] for c in columns])))
+
+    Predictor.query.filter(
+        Predictor.id.in_(predictor_ids), Predictor.ef_id.isnot(None)).update(
+            {'materialized': True}, synchronize_session=False)
 
-    pes = dump_pe(pes)
+    if commit:
+        db.session.commit()
 
-    # Create & dump Extracted PEs
-    pes += create_pes(ext_preds, run_ids, stimulus_timing=stimulus_timing)
-    return pes
+
+def update_latest_predictors(predictor_ids, commit=True):
+    """ Update the LatestPredictor table for every (task, name, private)
+    combination covered by the given Predictors. Must be called once their
+    PredictorRuns exist, in the same transaction. Also refreshes the
+    combinations the Predictors were previously the newest of, so renamed
+    Predictors no longer shadow their former name.
+    Args:
+        predictor_ids - list of new (or updated) Predictor ids
+        commit - commit session
+    """
+    pred = Predictor.__table__
+    pr = PredictorRun.__table__
+    run = Run.__table__
+    lp = LatestPredictor.__table__
+    private = func.coalesce(pred.c.private, False)
+    source = pred.join(pr, pr.c.predictor_id == pred.c.id).join(
+        run, run.c.id == pr.c.run_id)
+    key = tuple_(run.c.task_id, pred.c.name, private)
+
+    # Combinations these Predictors were the newest of, under any name
+    stale = db.session.execute(
+        lp.delete().where(lp.c.predictor_id.in_(predictor_ids)).returning(
+            lp.c.task_id, lp.c.name, lp.c.private)).fetchall()
+
+    keys = select([run.c.task_id, pred.c.name, private]).select_from(
+        source).where(pred.c.id.in_(predictor_ids)).distinct()
+    condition = key.in_(keys)
+    if stale:
+        condition = or_(condition, key.in_([tuple(k) for k in stale]))
+
+    newest = select([
+        run.c.task_id, pred.c.name, private.label('private'),
+        func.max(pred.c.id).label('predictor_id')
+    ]).select_from(source).where(condition).group_by(
+            run.c.task_id, pred.c.name, private)
+
+    statement = insert(lp).from_select(
+        ['task_id', 'name', 'private', 'predictor_id'], newest)
+    statement = statement.on_conflict_do_update(
+        index_elements=['task_id', 'name', 'private'],
+        set_={'predictor_id': statement.excluded.predictor_id})
+    db.session.execute(statement)
+
+    if commit:
+        db.session.commit()
+
+
+def _fetch_chunks(statement, chunk_size=10000):
+    """ Execute core SQL statement using a server-side cursor,
+    yielding chunks of rows as they come off the cursor """
+    res = db.session.connection().execution_options(
+        stream_results=True).execute(statement)
+    try:
+        while True:
+            rows = res.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        res.close()
+
+
+def stream_columns(statement, columns, chunk_size=10000):
+    """ Execute core SQL statement using a server-side cursor, and
+    collect results into columnar lists, without building a dict per row.
+    Returns a dictionary of column names to lists of values """
+    columnar = {c: [] for c in columns}
+    for rows in _fetch_chunks(statement, chunk_size):
+        for col, values in zip(columns, zip(*rows)):
+            columnar[col].extend(values)
+    return columnar
+
+
+def _predictor_events_query(predictor_ids, run_ids=None,
+                            stimulus_timing=False):
+    """ Single query for Raw, materialized and on the fly Extracted
+    PredictorEvents.
+    Returns column names and core SQL statement """
+    columns = PE_COLUMNS
+    if stimulus_timing:
+        columns += STIMULUS_TIMING_COLUMNS
+
+    statement = union_all(
+        _raw_pes(predictor_ids, run_ids, stimulus_timing),
+        _materialized_pes(predictor_ids, run_ids, stimulus_timing),
+        create_pes(predictor_ids, run_ids, stimulus_timing)
+    )
+    return columns, statement
+
+
+def dump_predictor_events(predictor_ids, run_ids=None, stimulus_timing=False,
+                          columnar=False):
+    """ Query & serialize PredictorEvents, for both Raw and Extracted
+    Predictors (which require creating PEs from EEs) in a single query.
+    Args:
+        predictor_ids - list of Predictor ids
+        run_ids - optional list of Run ids to restrict events to
+        stimulus_timing - include stimulus timing and information
+        columnar - return a dictionary of column lists, rather than
+                   a list of dictionaries (one per event)
+    """
+    columns, statement = _predictor_events_query(
+        predictor_ids, run_ids, stimulus_timing)
+    pes = stream_columns(statement, columns)
+
+    if columnar:
+        return pes
+    return [dict(zip(columns, r)) for r in zip(*pes.values())]
+
+
+def iter_predictor_events(predictor_ids, run_ids=None, stimulus_timing=False,
+                          chunk_size=10000):
+    """ Lazily query PredictorEvents, yielding chunks (lists of dictionaries)
+    as rows come off a server-side cursor. Memory use is bounded by
+    chunk_size, regardless of the number of runs and predictors """
+    columns, statement = _predictor_events_query(
+        predictor_ids, run_ids, stimulus_timing)
+    for rows in _fetch_chunks(statement, chunk_size):
+        yield [dict(zip(columns, r)) for r in rows]
 
 
 @listens_for(Analysis, "after_insert")
@@ -148,6 +305,94 @@ def put_record(updated_values, instance, commit=True):
         abort(400, "Error updating field")
 
 
+def bulk_insert(table, rows, chunk_size=5000, returning=None,
+                index_elements=None, update=None):
+    """ Insert rows using multi-row INSERT statements, in chunks.
+    Args:
+        table - SQLAlchemy Table
+        rows - list of dictionaries, with identical keys
+        chunk_size - number of rows per statement
+        returning - optional list of columns to return for inserted rows
+        index_elements - optional unique columns. If given, conflicting rows
+                         are skipped (ON CONFLICT DO NOTHING)...
+        update - ...unless a list of columns to update is given
+                 (ON CONFLICT DO UPDATE)
+    Returns:
+        list of returned rows
+    """
+    results = []
+    for ix in range(0, len(rows), chunk_size):
+        statement = insert(table).values(rows[ix:ix + chunk_size])
+        if index_elements is not None:
+            if update:
+                statement = statement.on_conflict_do_update(
+                    index_elements=index_elements,
+                    set_={c: statement.excluded[c] for c in update})
+            else:
+                statement = statement.on_conflict_do_nothing(
+                    index_elements=index_elements)
+        if returning is not None:
+            statement = statement.returning(*returning)
+        res = db.session.execute(statement)
+        if returning is not None:
+            results += res.fetchall()
+    return results
+
+
+def _copy_text(values):
+    """ Format an array as a column of a COPY text stream """
+    values = np.asarray(values, dtype=object)
+    text = pd.Series(values.astype(str), dtype=object)
+    for char, escaped in (('\\', '\\\\'), ('\t', '\\t'),
+                          ('\n', '\\n'), ('\r', '\\r')):
+        text = text.str.replace(char, escaped, regex=False)
+    return text.where(values != None, '\\N')  # noqa: E711
+
+
+def copy_insert(table, chunks, buffer_rows=100000):
+    """ Insert rows using COPY, in the current transaction.
+    Args:
+        table - SQLAlchemy Table
+        chunks - iterable of dictionaries of column arrays, with identical
+                 keys. Scalars are broadcast to the length of the arrays.
+        buffer_rows - number of rows to buffer per COPY statement
+    Returns:
+        number of rows inserted
+    """
+    cursor = db.session.connection().connection.cursor()
+    buffer, columns, n_buffered, n_rows = StringIO(), None, 0, 0
+
+    def _flush():
+        buffer.seek(0)
+        cursor.copy_expert(
+            'COPY {} ({}) FROM STDIN'.format(table.name, ', '.join(columns)),
+            buffer)
+        buffer.seek(0)
+        buffer.truncate()
+
+    for chunk in chunks:
+        if columns is None:
+            columns = sorted(chunk)
+        length = max(
+            (len(v) for v in chunk.values() if np.ndim(v)), default=1)
+        if length == 0:
+            continue
+        cols = [_copy_text(np.broadcast_to(chunk[c], length))
+                for c in columns]
+        lines = cols[0].str.cat(cols[1:], sep='\t') if len(cols) > 1 \
+            else cols[0]
+        buffer.write('\n'.join(lines) + '\n')
+        n_buffered += length
+        n_rows += length
+        if n_buffered >= buffer_rows:
+            _flush()
+            n_buffered = 0
+
+    if n_buffered:
+        _flush()
+    return n_rows
+
+
 def get_or_create(model, commit=True, **kwargs):
     """ Checks to see if instance of model is in db.
     If not add and commit. If true, return all matches.